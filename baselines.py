@@ -12,7 +12,8 @@ from torch_geometric.utils.convert import to_networkx
 
 from data.loader import construct_dataset
 from problem.problems import get_problem
-from problem.baselines import e1_projector, random_hyperplane_projector
+from problem.walksat import walksat
+from problem.baselines import e1_projector, random_hyperplane_projector, tabu_projector, annealing_projector
 from utils.parsing import parse_baseline_args
 from utils.graph_utils import complement_graph
 
@@ -49,6 +50,8 @@ if __name__ == '__main__':
     project_fns = {
       'e1': e1_projector,
       'random_hyperplane': random_hyperplane_projector,
+      'tabu': tabu_projector,
+      'annealing': annealing_projector,
     }
 
     results = []
@@ -75,7 +78,7 @@ if __name__ == '__main__':
             lift_time = time.time() - start_time
 
             # NOTE: no penalty in return
-            lift_score = problem.score(args, x_lift, example)
+            lift_score, _, lift_constraint = problem.evaluate(args, x_lift, example)
             res = {
                 'index': i,
                 'method': lift_name,
@@ -84,35 +87,37 @@ if __name__ == '__main__':
                 'time': lift_time,
                 'runtime': runtime, # as reported by problem.solver_stats.solve_time
                 'score': float(lift_score),
+                'constraint': float(lift_constraint),
                 #'penalty': float(lift_penalty),
                 'x': x_lift.tolist(),
             }
             outfile.write(json.dumps(res) + '\n')
             outfile.flush()
             results.append(res)
-            print(f"Lift method {lift_name} fractional score {lift_score}")
+            print(f"Lift method {lift_name} fractional score {float(lift_score)}")
 
             # now use each project method and save scores
             for project_name, project_fn in project_fns.items():
                 start_time = time.time()
-                x_project = torch.FloatTensor(project_fn(args, x_lift, example, problem.score))
+                x_project = torch.FloatTensor(project_fn(args, x_lift, example, problem.batch_score))
                 proj_time = time.time() - start_time
 
                 # NOTE: no penalty in return
-                project_score = problem.score(args, x_project, example)
+                project_score, _, project_constraint = problem.evaluate(args, x_project, example)
                 res = {
                     'index': i,
                     'method': f"{lift_name}|{project_name}",
                     'type': 'lift_project',
                     'time': proj_time,
                     'score': float(project_score),
+                    'constraint': float(project_constraint),
                     #'penalty': float(project_penalty),
                     'x': x_project.tolist(),
                 }
                 outfile.write(json.dumps(res) + '\n')
                 outfile.flush()
                 results.append(res)
-                print(f"  Project method {project_name} integral score {project_score}")
+                print(f"  Project method {project_name} integral score {float(project_score)}")
 
         # run gurobi
         if args.gurobi:
@@ -120,8 +125,8 @@ if __name__ == '__main__':
             x_gurobi, status, runtime = problem.gurobi(args, example)
             gurobi_time = time.time() - start_time
 
-            gurobi_score = problem.score(args, x_gurobi, example)
-            print(f"Gurobi integral score {gurobi_score}")
+            gurobi_score, _, gurobi_constraint = problem.evaluate(args, x_gurobi, example)
+            print(f"Gurobi integral score {float(gurobi_score)}")
 
             res = {
                 'index': i,
@@ -131,6 +136,7 @@ if __name__ == '__main__':
                 'time': gurobi_time,
                 'runtime': runtime, # as reported by m.Runtime
                 'score': float(gurobi_score),
+                'constraint': float(gurobi_constraint),
                 #'penalty': float(gurobi_penalty),
                 'x': x_gurobi.tolist(),
             }
@@ -156,4 +162,25 @@ if __name__ == '__main__':
             outfile.flush()
             results.append(res)
 
+        # run walksat from random assignments
+        if args.walksat:
+            start_time = time.time()
+            X = torch.randint(0, 2, (args.walksat_restarts, example.num_nodes)) * 2. - 1.
+            X, satisfied = walksat(args, X, example, steps=args.walksat_steps, method=args.walksat_method)
+            best = int(torch.argmax(satisfied[:, 0]))
+            walksat_time = time.time() - start_time
+
+            res = {
+                'index': i,
+                'method': args.walksat_method,
+                'type': 'solver',
+                'time': walksat_time,
+                'score': int(satisfied[best, 0]),
+                'x': X[best, :example.num_vars].tolist(),
+            }
+            outfile.write(json.dumps(res) + '\n')
+            outfile.flush()
+            results.append(res)
+            print(f"{args.walksat_method} satisfied clauses {int(satisfied[best, 0])} of {example.num_clauses}")
+
     # TODO print some summary statistics
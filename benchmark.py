@@ -0,0 +1,181 @@
+# Benchmarks comparing execution modes on the same data and model configuration.
+# Takes the same arguments as train.py, e.g. the README examples:
+#
+# python benchmark.py --benchmark=compile --problem_type=max_cut \
+#                     --dataset=ErdosRenyi --gen_n=100 --gen_p=0.15 \
+#                     --model_type=LiftMP --num_layers=16 --rank=16 --batch_size=32
+#
+# Use --finetune_from=[model file] to benchmark a trained model instead of a fresh one.
+
+import itertools
+import os
+import time
+
+import matplotlib.pyplot as plt
+import torch
+
+from data.loader import construct_loaders, test_datasets
+from model.models import construct_model, maybe_compile
+from model.training import featurize_batch, run_inference
+from problem.baselines import random_hyperplane_projector
+from problem.problems import get_problem
+from utils.parsing import parse_benchmark_args
+
+# cycle through a loader forever, for both finite and infinite datasets
+def cycle_batches(loader):
+    while True:
+        for batch in loader:
+            yield batch
+
+# time training steps (forward, loss, backward, optimizer step); returns steps per second
+def time_train_steps(args, model, optimizer, loss_fn, batches, steps, warmup_steps):
+    model.train()
+    for i, batch in enumerate(itertools.islice(batches, warmup_steps + steps)):
+        if i == warmup_steps:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start_time = time.time()
+
+        x_in, batch = featurize_batch(args, batch)
+        x_out = model(x_in, batch)
+        loss = loss_fn(x_out, batch)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return steps / (time.time() - start_time)
+
+# time inference steps (the model's inference path, and the loss under no_grad); returns steps per second
+def time_eval_steps(args, model, loss_fn, batches, steps, warmup_steps):
+    model.eval()
+    with torch.no_grad():
+        for i, batch in enumerate(itertools.islice(batches, warmup_steps + steps)):
+            if i == warmup_steps:
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                start_time = time.time()
+
+            x_in, batch = featurize_batch(args, batch)
+            x_out = run_inference(args, model, x_in, batch)
+            loss_fn(x_out, batch)
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return steps / (time.time() - start_time)
+
+def benchmark_compile(args, train_loader, problem):
+    results = {}
+    for mode in ['eager', 'compiled']:
+        args.compile = mode == 'compiled'
+        torch.manual_seed(args.seed)
+        model, optimizer = construct_model(args)
+        model.to(args.device)
+        loss_fn = maybe_compile(problem.loss) if args.compile else problem.loss
+
+        batches = cycle_batches(train_loader)
+        train_rate = time_train_steps(args, model, optimizer, loss_fn, batches, args.benchmark_steps, args.warmup_steps)
+        eval_rate = time_eval_steps(args, model, loss_fn, batches, args.benchmark_steps, args.warmup_steps)
+        results[mode] = (train_rate, eval_rate)
+        print(f"{mode}: train steps/sec={train_rate:0.2f} eval steps/sec={eval_rate:0.2f}")
+
+    eager_train, eager_eval = results['eager']
+    compiled_train, compiled_eval = results['compiled']
+    print(f"speedup: train {compiled_train / eager_train:0.2f}x eval {compiled_eval / eager_eval:0.2f}x")
+    return results
+
+# report the change in relaxed loss and rounded per-graph scores from running the model in bf16
+# each batch gets the same input features and the same rounding hyperplanes in both precisions
+def benchmark_bf16(args, val_loader, problem):
+    model, _ = construct_model(args)
+    model.to(args.device)
+    model.eval()
+
+    losses = {'fp32': [], 'bf16': []}
+    scores = {'fp32': [], 'bf16': []}
+    times = {'fp32': 0., 'bf16': 0.}
+    with torch.no_grad():
+        for i, batch in enumerate(val_loader):
+            x_in, batch = featurize_batch(args, batch)
+            for precision in ['fp32', 'bf16']:
+                args.precision = precision
+                start_time = time.time()
+                x_out = run_inference(args, model, x_in, batch)
+                times[precision] += time.time() - start_time
+
+                losses[precision].append(float(problem.loss(x_out, batch)))
+
+                torch.manual_seed(i)
+                x_proj = random_hyperplane_projector(args, x_out, batch, problem.batch_score)
+                x_proj = torch.where(x_proj == 0, 1, x_proj)
+                scores[precision].append(problem.batch_score(args, x_proj, batch))
+
+    fp32_scores = torch.cat(scores['fp32'])
+    bf16_scores = torch.cat(scores['bf16'])
+    deltas = bf16_scores - fp32_scores
+    loss_deltas = torch.tensor(losses['bf16']) - torch.tensor(losses['fp32'])
+
+    print(f"graphs: {len(deltas)}")
+    print(f"fp32: mean score={float(fp32_scores.mean()):0.4f} forward time={times['fp32']:0.2f}")
+    print(f"bf16: mean score={float(bf16_scores.mean()):0.4f} forward time={times['bf16']:0.2f}")
+    print(f"score delta (bf16 - fp32): mean={float(deltas.mean()):0.4f} max abs={float(deltas.abs().max()):0.4f} \
+graphs changed={int((deltas != 0).count_nonzero())}")
+    print(f"loss delta (bf16 - fp32): mean={float(loss_deltas.mean()):0.4f} max abs={float(loss_deltas.abs().max()):0.4f}")
+    return deltas
+
+# mean best-of-H rounded score for each hyperplane sampler and each H in args.hyperplane_counts
+# the model runs once per batch, and every sampler rounds the same model output
+# plots score versus H to hyperplanes.png in the log directory
+def benchmark_hyperplanes(args, loader, problem):
+    model, _ = construct_model(args)
+    model.to(args.device)
+    model.eval()
+
+    samplers = ['gaussian', 'orthogonal', 'sobol', 'antithetic']
+    scores = {(sampler, H): [] for sampler in samplers for H in args.hyperplane_counts}
+    with torch.no_grad():
+        for i, batch in enumerate(itertools.islice(loader, args.benchmark_steps)):
+            x_in, batch = featurize_batch(args, batch)
+            x_out = run_inference(args, model, x_in, batch)
+
+            for sampler in samplers:
+                args.hyperplane_sampler = sampler
+                for H in args.hyperplane_counts:
+                    torch.manual_seed(i)
+                    x_proj = random_hyperplane_projector(args, x_out, batch, problem.batch_score, n_hyperplanes=H)
+                    x_proj = torch.where(x_proj == 0, 1, x_proj)
+                    scores[sampler, H].append(problem.batch_score(args, x_proj, batch))
+
+    for sampler in samplers:
+        means = [float(torch.cat(scores[sampler, H]).mean()) for H in args.hyperplane_counts]
+        print(f"{sampler}: " + " ".join(f"H={H}:{mean:0.4f}" for H, mean in zip(args.hyperplane_counts, means)))
+        plt.plot(args.hyperplane_counts, means, marker='o', label=sampler)
+
+    plt.xscale('log')
+    plt.xlabel('hyperplanes')
+    plt.ylabel('mean best score')
+    plt.title(f'{args.problem_type} on {args.dataset}')
+    plt.legend()
+    os.makedirs(args.log_dir, exist_ok=True)
+    plt.savefig(os.path.join(args.log_dir, 'hyperplanes.png'))
+    return scores
+
+if __name__ == '__main__':
+    args = parse_benchmark_args()
+    print(args)
+    torch.manual_seed(args.seed)
+
+    problem = get_problem(args)
+    if args.dataset in test_datasets:
+        # test-only datasets such as gset have no train or validation split
+        train_loader = val_loader = construct_loaders(args, mode="test")
+    else:
+        train_loader, val_loader, _ = construct_loaders(args)
+
+    if args.benchmark == 'compile':
+        benchmark_compile(args, train_loader, problem)
+    elif args.benchmark == 'bf16':
+        benchmark_bf16(args, val_loader, problem)
+    elif args.benchmark == 'hyperplanes':
+        benchmark_hyperplanes(args, val_loader, problem)
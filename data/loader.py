@@ -9,7 +9,7 @@ from torch_geometric.datasets import TUDataset, PPI
 from torch_geometric.transforms import AddRandomWalkPE, Compose, ToDevice
 
 from data.generated import construct_generator, GeneratedDataset, GeneratedIterableDataset
-from data.transforms import AddLaplacianEigenvectorPE, ToComplement
+from data.transforms import AddLaplacianEigenvectorPE, ToComplement, ToHalfEdges
 from data.test_sets import construct_kamis_dataset, construct_gset_dataset
 
 generated_datasets = [
@@ -76,6 +76,10 @@ def construct_dataset(args):
     elif args.positional_encoding is not None:
         raise ValueError(f"Invalid positional encoding passed into construct_dataset: {args.positional_encoding}")
 
+    # store each undirected edge once; applied on load so cached datasets are unaffected
+    if getattr(args, 'half_edges', False):
+        transform = ToHalfEdges()
+
     if args.dataset in generated_datasets:
         generator, name = construct_generator(args)
         if not args.infinite:
@@ -2,9 +2,13 @@
 import itertools
 import numpy as np
 import torch
-from torch_geometric.utils import to_edge_index
+import torch.nn.functional as F
+from torch_geometric.utils import to_edge_index, scatter
 from torch_geometric.data import Data, Batch
 
+from problem.operators import get_operator
+from problem.bitpack import packed_clause_sat
+
 class SDPCompiler():
     def __init__(self, N):
         self.N = N
@@ -71,36 +75,146 @@ def sdp_objective(X, batch):
     A1w = batch.bias_weight
     linear = torch.sum(X[A1i, 0] * A1w)
 
-    # quadratic term ("edge")
-    A2i = batch.edge_index
-    A2w = batch.edge_weight
-    edges = torch.sum(X[A2i[0, :]] * X[A2i[1, :]], dim=1)
-    quadratic = torch.sum(edges * A2w)
+    # quadratic term ("edge"), in chunks of edges if there is a memory budget
+    op = get_operator(batch)
+    def edge_sum(start, end):
+        edges = torch.sum(X[op.src[start:end]] * X[op.dst[start:end]], dim=1)
+        return torch.sum(edges * op.edge_weight[start:end])
+
+    bytes_per_term = 3 * X.shape[1] * X.element_size()
+    quadratic = op.chunked_sum(edge_sum, op.num_edges, bytes_per_term, X.requires_grad)
 
     objective = const + linear + quadratic
     return objective
 
 def sdp_constraint(X, batch):
+    op = get_operator(batch)
+    bytes_per_term = 5 * X.shape[1] * X.element_size()
+
+    # constraints involving e1
+    C3 = batch.C3_index
+    def constraint3_sum(start, end):
+        C = C3[:, start:end]
+        constraints3 = X[C[0, :], 0] - torch.sum(X[C[1, :]] * X[C[2, :]], dim=1)
+        return torch.sum(constraints3 * constraints3)
+
+    # constraints not involving e1
+    C4 = batch.C4_index
+    def constraint4_sum(start, end):
+        C = C4[:, start:end]
+        constraints4 = torch.sum(X[C[0, :]] * X[C[1, :]] - X[C[2, :]] * X[C[3, :]], dim=1)
+        return torch.sum(constraints4 * constraints4)
+
+    constraint = op.chunked_sum(constraint3_sum, C3.shape[1], bytes_per_term, X.requires_grad) + \
+        op.chunked_sum(constraint4_sum, C4.shape[1], bytes_per_term, X.requires_grad)
+    return constraint / 4.
+
+# per-graph sdp_objective; X may carry leading candidate dimensions: (..., N, r) -> (..., num_graphs)
+def sdp_graph_objective(X, batch):
+    op = get_operator(batch)
+
+    # constant term
+    const = batch.A0
+
+    # linear term ("bias")
+    A1i = batch.bias_index
+    A1w = batch.bias_weight
+    linear = op.graph_sum(X[..., A1i, 0] * A1w, op.node_graph[A1i])
+
+    # quadratic term ("edge")
+    def edge_sum(start, end):
+        edges = torch.sum(X[..., op.src[start:end], :] * X[..., op.dst[start:end], :], dim=-1)
+        return op.graph_sum(edges * op.edge_weight[start:end], op.edge_graph[start:end])
+
+    bytes_per_term = 3 * X[..., 0, :].numel() * X.element_size()
+    quadratic = op.chunked_sum(edge_sum, op.num_edges, bytes_per_term, X.requires_grad)
+
+    return const + linear + quadratic
+
+# per-graph sdp_constraint; X may carry leading candidate dimensions: (..., N, r) -> (..., num_graphs)
+def sdp_graph_constraint(X, batch):
+    op = get_operator(batch)
+    bytes_per_term = 5 * X[..., 0, :].numel() * X.element_size()
+
     # constraints involving e1
     C3 = batch.C3_index
-    constraints3 = X[C3[0, :], 0] - torch.sum(X[C3[1, :]] * X[C3[2, :]], dim=1)
+    def constraint3_sum(start, end):
+        C = C3[:, start:end]
+        constraints3 = X[..., C[0, :], 0] - torch.sum(X[..., C[1, :], :] * X[..., C[2, :], :], dim=-1)
+        return op.graph_sum(constraints3 * constraints3, op.node_graph[C[0, :]])
 
     # constraints not involving e1
     C4 = batch.C4_index
-    constraints4 = torch.sum(X[C4[0, :]] * X[C4[1, :]] - X[C4[2, :]] * X[C4[3, :]], dim=1)
+    def constraint4_sum(start, end):
+        C = C4[:, start:end]
+        constraints4 = torch.sum(X[..., C[0, :], :] * X[..., C[1, :], :] - X[..., C[2, :], :] * X[..., C[3, :], :], dim=-1)
+        return op.graph_sum(constraints4 * constraints4, op.node_graph[C[0, :]])
 
-    constraint = torch.sum(constraints3 * constraints3) + torch.sum(constraints4 * constraints4)
+    constraint = op.chunked_sum(constraint3_sum, C3.shape[1], bytes_per_term, X.requires_grad) + \
+        op.chunked_sum(constraint4_sum, C4.shape[1], bytes_per_term, X.requires_grad)
     return constraint / 4.
 
+# gradient of sdp_objective w.r.t. X
+def sdp_objective_grad(X, batch):
+    N = X.shape[0]
+
+    # linear term ("bias") only touches the e1 coordinate
+    A1i = batch.bias_index
+    A1w = batch.bias_weight
+    linear = scatter(A1w, A1i, dim=0, dim_size=N, reduce='sum')
+    linear = F.pad(linear[:, None], (0, X.shape[1] - 1))
+
+    # quadratic term ("edge"): (A + A^T) X
+    quadratic = get_operator(batch).matmul(X)
+
+    return linear + quadratic
+
+# gradient of sdp_constraint w.r.t. X
+# d/dX c^2 / 4 = c / 2 * dc/dX for each constraint residual c
+def sdp_constraint_grad(X, batch):
+    op = get_operator(batch)
+    N = X.shape[0]
+    r = X.shape[1]
+
+    # constraints involving e1: c = <x_p, e1> - <x_q, x_r>
+    C3 = batch.C3_index
+    def constraint3_grad(start, end):
+        C = C3[:, start:end]
+        X3q = X[C[1, :]]
+        X3r = X[C[2, :]]
+        constraints3 = (X[C[0, :], 0] - torch.sum(X3q * X3r, dim=1)) / 2.
+        e1_grad = scatter(constraints3, C[0, :], dim=0, dim_size=N, reduce='sum')
+        e1_grad = F.pad(e1_grad[:, None], (0, r - 1))
+        index = torch.cat((C[1, :], C[2, :]))
+        messages = -torch.cat((X3r, X3q)) * constraints3.repeat(2)[:, None]
+        return e1_grad + scatter(messages, index, dim=0, dim_size=N, reduce='sum')
+
+    # constraints not involving e1: c = <x_a, x_b> - <x_c, x_d>
+    C4 = batch.C4_index
+    def constraint4_grad(start, end):
+        C = C4[:, start:end]
+        X4a = X[C[0, :]]
+        X4b = X[C[1, :]]
+        X4c = X[C[2, :]]
+        X4d = X[C[3, :]]
+        constraints4 = torch.sum(X4a * X4b - X4c * X4d, dim=1) / 2.
+        index = torch.cat((C[0, :], C[1, :], C[2, :], C[3, :]))
+        messages = torch.cat((X4b, X4a, -X4d, -X4c)) * constraints4.repeat(4)[:, None]
+        return scatter(messages, index, dim=0, dim_size=N, reduce='sum')
+
+    return op.chunked_sum(constraint3_grad, C3.shape[1], 5 * r * X.element_size(), X.requires_grad) + \
+        op.chunked_sum(constraint4_grad, C4.shape[1], 13 * r * X.element_size(), X.requires_grad)
+
 # turn a DIMACS input into a clause-list representation
 def dimacs_parser():
     pass
 
 def dimacs_printer(N, K, clauses, signs):
+    clauses, signs = clause_tensors(clauses, signs)
     out = f"p cnf {N} {K}\n"
-    signed_clauses = (clauses + 1) * signs
+    signed_clauses = ((clauses + 1) * signs.long()).tolist()
     for f in range(K):
-        out += f"{signed_clauses[f, 0]} {signed_clauses[f, 1]} {signed_clauses[f, 2]} 0\n"
+        out += f"{signed_clauses[f][0]} {signed_clauses[f][1]} {signed_clauses[f][2]} 0\n"
     return out
 
 # generate clause-list representation of random 3-SAT problem
@@ -223,8 +337,9 @@ def compile_sat(clauses, signs, N, K):
 
     data.num_vars = N
     data.num_clauses = K
-    data.clause_index = clauses
-    data.signs = signs
+    # stored as tensors so they batch: clause_index is (3, K) node indices, incremented like edge_index
+    data.clause_index = torch.as_tensor(clauses, dtype=torch.long).t().contiguous()
+    data.signs = torch.as_tensor(signs, dtype=torch.float)
 
     return total_vars, pair_to_index, data
 
@@ -255,20 +370,119 @@ def random_3sat_generator(seed, n_min=100, n_max=100, k_min=400, k_max=400, p_mi
 
         yield data
 
-# count number of satisfied clauses
-def count_sat_clauses(X, clauses, signs):
-    count = 0
-    for f in range(len(clauses)):
-        i = int(clauses[f, 0])
-        j = int(clauses[f, 1])
-        k = int(clauses[f, 2])
-        tau_i = signs[f, 0]
-        tau_j = signs[f, 1]
-        tau_k = signs[f, 2]
+# clauses (K, 3) and signs (K, 3) as tensors, from either the (3, K) clause_index tensor stored by compile_sat
+# or legacy (K, 3) numpy arrays
+def clause_tensors(clauses, signs, device=None):
+    if isinstance(clauses, torch.Tensor):
+        clauses = clauses.t()
+    clauses = torch.as_tensor(clauses, dtype=torch.long, device=device)
+    signs = torch.as_tensor(signs, dtype=torch.float, device=device)
+    return clauses, signs
 
-        if tau_i * X[i] == 1 or tau_j * X[j] == 1 or tau_k * X[k] == 1:
-            count += 1
+# clauses (K, 3) as node indices into the batch, signs (K, 3) of +/- 1, and the formula of each clause (K,)
+def sat_clauses(batch):
+    device = get_operator(batch).node_graph.device
+    if isinstance(batch, Batch) and isinstance(batch.clause_index, list):
+        # legacy numpy attributes are collated as a list per formula, with node indices local to each formula
+        offsets = batch.ptr[:-1]
+        clauses, signs, clause_graph = [], [], []
+        for g, (c, t) in enumerate(zip(batch.clause_index, batch.signs)):
+            c, t = clause_tensors(c, t, device=device)
+            clauses.append(c + offsets[g])
+            signs.append(t)
+            clause_graph.append(torch.full((len(c),), g, device=device))
+        return torch.cat(clauses), torch.cat(signs), torch.cat(clause_graph)
+
+    clauses, signs = clause_tensors(batch.clause_index, batch.signs, device=device)
+    if isinstance(batch, Batch):
+        num_clauses = torch.as_tensor(batch.num_clauses, device=device)
+        clause_graph = torch.repeat_interleave(torch.arange(batch.num_graphs, device=device), num_clauses)
+    else:
+        clause_graph = torch.zeros(len(clauses), dtype=torch.long, device=device)
+    return clauses, signs, clause_graph
+
+# 0/1 for each clause: is it satisfied by the +/- 1 assignments X (..., N)? gives (..., K)
+def satisfied_clauses(X, clauses, signs):
+    return (signs * X[..., clauses] > 0).any(dim=-1)
+
+# number of satisfied clauses in each formula of the batch, for +/- 1 assignments X (..., N) or (..., N, 1)
+# gives (..., num_graphs)
+def sat_clause_counts(X, batch):
+    if X.dim() > 1 and X.shape[-1] == 1 and X.shape[-2] == batch.num_nodes:
+        X = X[..., 0]
+    clauses, signs, clause_graph = sat_clauses(batch)
+    satisfied = satisfied_clauses(X, clauses, signs)
+    return scatter(satisfied.float(), clause_graph, dim=-1, dim_size=get_operator(batch).num_graphs, reduce='sum')
+
+# satisfied clause counts (..., num_graphs) of bit-packed assignments (..., num_words) from problem/bitpack.py
+# clauses are visited in chunks of at most chunk_size, so only chunk-sized bit gathers are ever unpacked
+def sat_packed_clause_counts(words, batch, chunk_size=None):
+    op = get_operator(batch)
+    layout = op.bit_layout
+    clauses, signs, clause_graph = sat_clauses(batch)
+    K = len(clauses)
+    if chunk_size is None:
+        chunk_size = max(K, 1)
+
+    satisfied = 0.
+    for start in range(0, K, chunk_size):
+        end = min(start + chunk_size, K)
+        sat = packed_clause_sat(layout, words, clauses[start:end].t(), signs[start:end] < 0)
+        satisfied = satisfied + op.graph_sum(sat.float(), clause_graph[start:end])
+    if K == 0:
+        satisfied = torch.zeros(words.shape[:-1] + (op.num_graphs,), device=words.device)
+    return satisfied
+
+# a batch of just the single variables of each formula, with clause_index pointing into it, so that
+# SAT assignments can be rounded and scored without the pair variables
+# returns the variable batch, and the rows of batch holding its variables
+def variable_batch(batch):
+    op = get_operator(batch)
+    device = op.node_graph.device
+    clauses, signs, clause_graph = sat_clauses(batch)
+
+    if isinstance(batch, Batch):
+        num_vars = torch.as_tensor(batch.num_vars, device=device)
+        starts = batch.ptr[:-1]
+    else:
+        num_vars = torch.tensor([batch.num_vars], device=device)
+        starts = torch.zeros(1, dtype=torch.long, device=device)
+
+    # single variables come first in each formula's nodes
+    var_graph = torch.repeat_interleave(torch.arange(op.num_graphs, device=device), num_vars)
+    var_ptr = torch.cumsum(num_vars, dim=0) - num_vars
+    rows = starts[var_graph] + torch.arange(len(var_graph), device=device) - var_ptr[var_graph]
+
+    # clauses as indices local to each formula's variables
+    local_clauses = clauses - starts[clause_graph, None]
+    data_list = []
+    for g in range(op.num_graphs):
+        mask = clause_graph == g
+        data_list.append(Data(num_nodes=int(num_vars[g]),
+                              edge_index=torch.zeros((2, 0), dtype=torch.long, device=device),
+                              clause_index=local_clauses[mask].t().contiguous(),
+                              signs=signs[mask],
+                              num_vars=int(num_vars[g]),
+                              num_clauses=int(mask.sum())))
+    return Batch.from_data_list(data_list), rows
+
+# lift rounded single variable assignments X (..., num single variables) back to every row of batch,
+# setting each pair variable to the product of its singles. X itself is left untouched
+def expand_variables(X, rows, batch):
+    out = torch.zeros(X.shape[:-1] + (batch.num_nodes,), device=X.device)
+    out[..., rows] = X
+    pair_index = batch.pair_index
+    out[..., pair_index[0]] = out[..., pair_index[1]] * out[..., pair_index[2]]
+    return out
 
+# count number of satisfied clauses
+# X: (N,) assignment, or (..., N) assignments to count for separately
+def count_sat_clauses(X, clauses, signs):
+    X = torch.as_tensor(X)
+    clauses, signs = clause_tensors(clauses, signs, device=X.device)
+    count = satisfied_clauses(X, clauses, signs).sum(dim=-1)
+    if X.dim() == 1:
+        return int(count)
     return count
 
 # check count_sat_clauses(clauses, signs, assignment) == sat_objective(compile_sat(clauses, signs, ...), vectorize(assignment))
@@ -32,8 +32,8 @@ def construct_kamis_dataset(args, pre_transform=None, transform=None):
     #    datapoints = [y[0] for y in pickled_data[ds].values()]
     #    test_loader = DataLoader(datapoints, batch_size=args.batch_size, shuffle=False)
     # TODO add args for dataset names
-    return ListDataset([y[0] for y in pickled_data['er'].values()])
+    return ListDataset([y[0] for y in pickled_data['er'].values()], transform=transform)
 
 def construct_gset_dataset(args, pre_transform=None, transform=None):
     # TODO add args for dataset names
-    return ListDataset(load_gset('datasets/GSET'))
+    return ListDataset(load_gset('datasets/GSET'), transform=transform)
@@ -1,3 +1,4 @@
+import copy
 from typing import Any, Optional
 
 import networkx
@@ -8,6 +9,7 @@ from torch_geometric.data import Data
 from torch_geometric.data.datapipes import functional_transform
 from torch_geometric.transforms import BaseTransform
 from torch_geometric.utils import (
+    coalesce,
     get_laplacian,
     get_self_loop_attr,
     scatter,
@@ -102,3 +104,42 @@ class ToComplement(BaseTransform):
     def __call__(self, data: Data) -> Data:
         return complement_graph(data)
 
+
+@functional_transform('to_half_edges')
+class ToHalfEdges(BaseTransform):
+    r"""Stores each undirected edge once, as :obj:`(i, j)` with :obj:`i <= j`
+    (functional name: :obj:`to_half_edges`).
+
+    The weights of :obj:`(i, j)` and :obj:`(j, i)` are summed into
+    :obj:`edge_weight`, and :obj:`edge_multiplicity` records how many directed
+    edges each stored edge stands for. The losses in
+    :obj:`problem/losses.py` use these so that objectives, gradients, and
+    scores are identical to the two-direction representation, while
+    edge-level work is halved.
+    """
+    def __call__(self, data: Data) -> Data:
+        if 'edge_multiplicity' in data:
+            return data
+
+        data = copy.copy(data)
+        num_edges = data.edge_index.shape[1]
+        device = data.edge_index.device
+
+        edge_weight = data.edge_weight if 'edge_weight' in data else None
+        if edge_weight is None:
+            edge_weight = torch.ones(num_edges, device=device)
+        multiplicity = torch.ones(num_edges, device=device)
+
+        row, col = data.edge_index
+        edge_index = torch.stack((torch.minimum(row, col), torch.maximum(row, col)))
+        edge_index, (edge_weight, multiplicity) = coalesce(
+            edge_index,
+            [edge_weight, multiplicity],
+            num_nodes=data.num_nodes,
+            reduce='sum',
+        )
+
+        data.edge_index = edge_index
+        data.edge_weight = edge_weight
+        data.edge_multiplicity = multiplicity
+        return data
@@ -9,42 +9,56 @@ import torch
 import torch.nn.functional as F
 from torch.nn import Linear, Parameter, Sequential
 from torch.optim import Adam
+from torch.utils.checkpoint import checkpoint
 
+from torch_geometric.data import Batch
 from torch_geometric.nn import MessagePassing
 from torch_geometric.nn.models import GAT, GIN, GCN
 from torch_geometric.nn.conv import GatedGraphConv
+from torch_geometric.utils import scatter
 
 from model.more_models import NegationGAT
 from model.saving import load_model
 from utils.parsing import read_params_from_folder
-from problem.problems import get_problem
+from problem.problems import get_problem, has_grad
+from problem.operators import select_graphs
+
+# use the problem's closed-form loss gradient when it has one, otherwise autograd
+def construct_grad_layer(args):
+    problem = get_problem(args)
+    if has_grad(problem):
+        return GradientLayer(grad_fn=problem.grad)
+    return AutogradLayer(loss_fn=problem.loss)
 
 def construct_model(args):
     if args.model_type == 'LiftMP':
         model = LiftNetwork(
-          grad_layer=AutogradLayer(loss_fn=get_problem(args).loss),
+          grad_layer=construct_grad_layer(args),
           in_channels=args.rank,
           num_layers=args.num_layers,
           repeat_lift_layers=args.repeat_lift_layers,
+          checkpoint_layers=getattr(args, 'checkpoint_layers', 0),
         )
     elif args.model_type == 'FullMP':
         model = LiftProjectNetwork(
-          grad_layer=AutogradLayer(loss_fn=get_problem(args).loss),
+          grad_layer=construct_grad_layer(args),
           in_channels=args.rank,
           num_layers_lift=args.num_layers - args.num_layers_project,
           num_layers_project=args.num_layers_project,
           repeat_lift_layers=args.repeat_lift_layers,
+          checkpoint_layers=getattr(args, 'checkpoint_layers', 0),
         )
     elif args.model_type == "ProjectMP":
         # must have lift network to train.
         assert args.lift_file is not None
         model = LiftProjectNetwork(
-          grad_layer=AutogradLayer(loss_fn=get_problem(args).loss),
+          grad_layer=construct_grad_layer(args),
           in_channels=args.rank,
           num_layers_lift=args.num_layers - args.num_layers_project,
           num_layers_project=args.num_layers_project,
           lift_file=args.lift_file,
           repeat_lift_layers=args.repeat_lift_layers,
+          checkpoint_layers=getattr(args, 'checkpoint_layers', 0),
         )
 
     elif args.model_type == 'GIN':
@@ -71,6 +85,9 @@ def construct_model(args):
     else:
         raise ValueError(f'Got unexpected model_type {args.model_type}')
 
+    if getattr(args, 'compile', False):
+        compile_model(model)
+
     if args.finetune_from is not None:
         # load in model for finetuning
         model = load_model(model, args.finetune_from)
@@ -80,6 +97,43 @@ def construct_model(args):
 
     return model, opt
 
+# wrap fn with torch.compile
+# if compilation is unavailable, or the compiled fn raises, fall back to running fn eagerly from then on
+# only the forward call is guarded: a compiled backward that fails during loss.backward() still raises
+def maybe_compile(fn):
+    try:
+        compiled_fn = torch.compile(fn)
+    except Exception as e:
+        print(f"WARNING: torch.compile unavailable, running eagerly: {e}")
+        return fn
+
+    state = {'fn': compiled_fn}
+    def run(*args, **kwargs):
+        if state['fn'] is compiled_fn:
+            try:
+                return compiled_fn(*args, **kwargs)
+            except Exception as e:
+                print(f"WARNING: compiled {getattr(fn, '__name__', fn)} failed, falling back to eager: {e}")
+                state['fn'] = fn
+        return fn(*args, **kwargs)
+    return run
+
+# compile the dense per-layer updates and closed-form gradients of a LiftMP/FullMP/ProjectMP model in place
+# parameters and state_dict keys are unchanged, so checkpoints load either way
+# AutogradLayer is left eager, since compiled graphs do not support its double backward
+def compile_model(model):
+    for m in model.modules():
+        if isinstance(m, (LiftLayer, ProjectLayer)):
+            m.update = maybe_compile(m.update)
+        elif isinstance(m, GradientLayer):
+            m._grad_fn = maybe_compile(m._grad_fn)
+    return model
+
+# autocast disabled, so gradient layers run their sparse operator matmuls in fp32 under --precision=bf16
+# (sparse CSR matmuls have no bf16 kernel on CPU)
+def full_precision(x):
+    return torch.autocast(device_type=x.device.type, enabled=False)
+
 # use autograd on a given loss function to compute gradients
 class AutogradLayer(torch.nn.Module):
     def __init__(self, loss_fn):
@@ -87,14 +141,53 @@ class AutogradLayer(torch.nn.Module):
         self._loss_fn = loss_fn
 
     def forward(self, x, batch):
+        # at inference (grad disabled), take a plain first-order gradient on a detached copy of x
+        # so nothing from this layer outlives it
+        if not torch.is_grad_enabled():
+            with torch.enable_grad(), full_precision(x):
+                x = x.detach().float().requires_grad_(True)
+                loss = self._loss_fn(x, batch)
+                grad = torch.autograd.grad(loss, x)[0]
+            return grad.detach()
+
         # calculate the lift loss and take the gradient w.r.t. the input x
         # the result is expected to be autodiffable, and training should be unaffected
-        with torch.enable_grad():
+        with torch.enable_grad(), full_precision(x):
             x.requires_grad_(True)
             loss = self._loss_fn(x, batch)
             grad = torch.autograd.grad(loss, x, create_graph=True)[0]
             return grad
 
+# compute gradients with a closed-form expression for the loss gradient
+# e.g. for max cut this is message passing over the edges, (A + A^T) X
+# equal to AutogradLayer on the same loss, without the second-order graph
+class GradientLayer(torch.nn.Module):
+    def __init__(self, grad_fn):
+        super().__init__()
+        self._grad_fn = grad_fn
+
+    def forward(self, x, batch):
+        with full_precision(x):
+            return self._grad_fn(x.float(), batch)
+
+# apply layers to x in order
+# with checkpoint_layers = k > 0, while gradients are needed, checkpoint each run of k layers:
+# only the input to each run is kept, and the run is recomputed during backward
+def run_layers(layers, x, batch, checkpoint_layers=0):
+    if checkpoint_layers <= 0 or not torch.is_grad_enabled():
+        for l in layers:
+            x = l(x, batch)
+        return x
+
+    def run_segment(x, segment):
+        for l in segment:
+            x = l(x, batch)
+        return x
+
+    for i in range(0, len(layers), checkpoint_layers):
+        x = checkpoint(run_segment, x, layers[i:i + checkpoint_layers], use_reentrant=False)
+    return x
+
 class LiftLayer(torch.nn.Module):
     def __init__(self, grad_layer, in_channels):
         super().__init__()
@@ -103,14 +196,18 @@ class LiftLayer(torch.nn.Module):
 
     def forward(self, x, batch):
         grads = self.grad_layer(x, batch)
-        norm_grads = F.normalize(grads, dim=1)
+        return self.update(x, grads)
+
+    def update(self, x, grads):
+        # normalize in fp32 even when the linear layer runs under bf16 autocast
+        norm_grads = F.normalize(grads.float(), dim=1)
         out = torch.cat((x, norm_grads), 1)
         out = self.lin(out)
-        out = F.normalize(out, dim=1)
+        out = F.normalize(out.float(), dim=1)
         return out
 
 class LiftNetwork(torch.nn.Module):
-    def __init__(self, grad_layer, in_channels, num_layers=12, repeat_lift_layers=None):
+    def __init__(self, grad_layer, in_channels, num_layers=12, repeat_lift_layers=None, checkpoint_layers=0):
         super().__init__()
         if repeat_lift_layers is not None:
             # the number of layers must equal the length of the repeat array.
@@ -122,12 +219,66 @@ class LiftNetwork(torch.nn.Module):
         if repeat_lift_layers is None:
             repeat_lift_layers = [1 for _ in range(num_layers)]
         self.repeat_lift_layers = repeat_lift_layers
+        self.checkpoint_layers = checkpoint_layers
+
+        # per-graph number of layer applications used by the last early-exit inference call
+        self.layers_used = None
+
+    # every layer application, with repeats unrolled
+    def unrolled_layers(self):
+        return [l for l, repeat_l in zip(self.layers, self.repeat_lift_layers) for _ in range(repeat_l)]
 
     def forward(self, x, batch):
-        for l, repeat_l in zip(self.layers, self.repeat_lift_layers):
-            for _ in range(repeat_l):
-                x = l(x, batch)
-        return x
+        return run_layers(self.unrolled_layers(), x, batch, self.checkpoint_layers)
+
+    # forward pass without any autograd graph; only one layer's intermediates are alive at a time
+    # with exit_tol set, a graph stops once no node embedding moves more than exit_tol in one layer,
+    # and later layers run only on the graphs still changing
+    @torch.no_grad()
+    def inference(self, x, batch, exit_tol=None):
+        layers = self.unrolled_layers()
+        if exit_tol is None:
+            self.layers_used = None
+            return self(x, batch)
+
+        is_batch = isinstance(batch, Batch)
+        num_graphs = batch.num_graphs if is_batch else 1
+        layers_used = torch.full((num_graphs,), len(layers), dtype=torch.long, device=x.device)
+
+        # the still-active graphs, and the positions of their nodes in x
+        x_out = x.clone()
+        active = torch.arange(num_graphs, device=x.device)
+        node_index = torch.arange(x.shape[0], device=x.device)
+        for i, l in enumerate(layers):
+            x_next = l(x, batch)
+            if i == len(layers) - 1:
+                x = x_next
+                break
+
+            # largest embedding change in each active graph
+            node_graph = batch.batch if is_batch else torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+            change = scatter((x_next - x).norm(dim=1), node_graph, dim=0, dim_size=len(active), reduce='max')
+            x = x_next
+
+            converged = change < exit_tol
+            if not converged.any():
+                continue
+
+            x_out[node_index] = x
+            layers_used[active[converged]] = i + 1
+            if converged.all():
+                break
+
+            keep = (~converged).nonzero().flatten()
+            node_mask = ~converged[node_graph]
+            active = active[keep]
+            node_index = node_index[node_mask]
+            x = x[node_mask]
+            batch = select_graphs(batch, keep)
+
+        x_out[node_index] = x
+        self.layers_used = layers_used
+        return x_out
 
 # Nearly identical to the lift layer. The big difference is that we no longer normalize in update.
 class ProjectLayer(torch.nn.Module):
@@ -138,25 +289,32 @@ class ProjectLayer(torch.nn.Module):
 
     def forward(self, x, batch):
         grads = self.grad_layer(x, batch)
+        return self.update(x, grads)
+
+    def update(self, x, grads):
         out = torch.cat((x, grads), 1)
         out = self.lin(out)
-        out = F.tanh(out)
+        out = F.tanh(out.float())
         return out
 
 class ProjectNetwork(torch.nn.Module):
-    def __init__(self, grad_layer, in_channels, num_layers=8):
+    def __init__(self, grad_layer, in_channels, num_layers=8, checkpoint_layers=0):
         super().__init__()
         self.layers = [ProjectLayer(grad_layer, in_channels) for _ in range(num_layers)]
         for i, layer in enumerate(self.layers):
             self.add_module(f"layer_{i}", layer)
+        self.checkpoint_layers = checkpoint_layers
 
     def forward(self, x, batch):
-        for l in self.layers:
-            x = l(x, batch)
-        return x
+        return run_layers(self.layers, x, batch, self.checkpoint_layers)
+
+    # forward pass without any autograd graph; only one layer's intermediates are alive at a time
+    @torch.no_grad()
+    def inference(self, x, batch):
+        return self(x, batch)
 
 class LiftProjectNetwork(torch.nn.Module):
-    def __init__(self, in_channels, num_layers_lift, num_layers_project, grad_layer, lift_file=None, repeat_lift_layers=None):
+    def __init__(self, in_channels, num_layers_lift, num_layers_project, grad_layer, lift_file=None, repeat_lift_layers=None, checkpoint_layers=0):
         super().__init__()
 
         if lift_file is not None:
@@ -182,8 +340,8 @@ class LiftProjectNetwork(torch.nn.Module):
                 param.requires_grad = False
             
         else:
-            self.lift_net = LiftNetwork(grad_layer, in_channels, num_layers=num_layers_lift, repeat_lift_layers=repeat_lift_layers)
-        self.project_net = ProjectNetwork(grad_layer, in_channels, num_layers=num_layers_project)
+            self.lift_net = LiftNetwork(grad_layer, in_channels, num_layers=num_layers_lift, repeat_lift_layers=repeat_lift_layers, checkpoint_layers=checkpoint_layers)
+        self.project_net = ProjectNetwork(grad_layer, in_channels, num_layers=num_layers_project, checkpoint_layers=checkpoint_layers)
 
     def forward(self, x, batch):
         out = self.lift_net(x, batch)
@@ -191,6 +349,17 @@ class LiftProjectNetwork(torch.nn.Module):
         out = self.project_net(out, batch)
         return out
 
+    # exit_tol applies to the lift network; the project layers always all run
+    @torch.no_grad()
+    def inference(self, x, batch, exit_tol=None):
+        if exit_tol is None:
+            out = self.lift_net.inference(x, batch)
+        else:
+            out = self.lift_net.inference(x, batch, exit_tol=exit_tol)
+        self.layers_used = getattr(self.lift_net, 'layers_used', None)
+        out = self.project_net.inference(out, batch)
+        return out
+
 # graph isomorphism network
 # TODO version with gradients, version allowing negation of neighbors
 class GINLiftNetwork(torch.nn.Module):
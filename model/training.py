@@ -6,8 +6,15 @@ import torch
 import torch.nn.functional as F
 
 from model.saving import save_model
+from model.models import maybe_compile
 from problem.baselines import random_hyperplane_projector
+from problem.operators import GraphOperator
+from problem.problems import has_packed_score
+from problem.local_search import batch_local_search, tabu_search, parallel_tempering, best_candidates
+from problem.walksat import walksat
+from data.sat import sat_clause_counts, variable_batch, expand_variables
 
+from torch_geometric.data import Batch
 from torch_geometric.transforms import AddRandomWalkPE
 
 def featurize_batch(args, batch):
@@ -39,45 +46,188 @@ def featurize_batch(args, batch):
     else:
         raise ValueError(f"Invalid transform passed into featurize_batch: {args.transform}")
 
+    # sparse operator shared by every layer, loss, and scoring call on this batch
+    memory_budget = getattr(args, 'loss_memory_budget', None)
+    if memory_budget is not None:
+        memory_budget = memory_budget * 2**20
+    batch.operator = GraphOperator(batch, memory_budget=memory_budget)
+
     # TODO handling multi-penalty situations -- shouldn't be in featurize
     batch.penalty = args.penalty
 
     return x_in, batch
 
+# autocast context for the model forward pass when running with --precision=bf16
+# losses and scores are always computed outside of it, in fp32
+def precision_context(args):
+    device_type = torch.device(args.device).type
+    enabled = getattr(args, 'precision', 'fp32') == 'bf16'
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=enabled)
+
+# forward pass for evaluation: the model's inference path if it has one, otherwise forward under no_grad
+# with --exit_tol, lift networks stop early on converged graphs (see LiftNetwork.inference)
+def run_inference(args, model, x_in, batch):
+    exit_tol = getattr(args, 'exit_tol', None)
+    with precision_context(args):
+        if hasattr(model, 'inference') and exit_tol is not None:
+            x_out = model.inference(x_in, batch, exit_tol=exit_tol)
+        elif hasattr(model, 'inference'):
+            x_out = model.inference(x_in, batch)
+        else:
+            with torch.no_grad():
+                x_out = model(x_in, batch)
+    return x_out.float()
+
+# per-graph satisfied clause counts, as a rounding score_fn
+def sat_score(args, X, batch):
+    return sat_clause_counts(X, batch)
+
+# round x_out to +/- 1 assignments for every graph in the batch, following the rounding args
+# with --local_search, the top --local_search_candidates rounded assignments of each graph are refined
+# together by --refinement (greedy flip sweeps, tabu search, parallel tempering, or walksat for sat),
+# and the best one is kept
+# returns the (N,) assignment and the number of hyperplanes each graph was rounded with
+def round_batch(args, x_out, batch, problem):
+    packed_score_fn = None
+    if getattr(args, 'packed_rounding', False) and has_packed_score(problem):
+        packed_score_fn = problem.packed_score
+
+    refine = getattr(args, 'local_search', False)
+    top_k = getattr(args, 'local_search_candidates', 1) if refine else None
+
+    # for SAT, only the single variables are rounded, scored by their satisfied clauses
+    # the pair variables are then set from them
+    round_x, round_batch_, score_fn = x_out, batch, problem.batch_score
+    if args.problem_type == 'sat':
+        round_batch_, rows = variable_batch(batch)
+        round_x, score_fn = x_out[rows], sat_score
+
+    x_proj, hyperplanes_used = random_hyperplane_projector(args, round_x, round_batch_, score_fn,
+                                                           n_hyperplanes=getattr(args, 'hyperplanes', 1000),
+                                                           packed_score_fn=packed_score_fn,
+                                                           patience=getattr(args, 'rounding_patience', None),
+                                                           time_budget=getattr(args, 'rounding_time_budget', None),
+                                                           return_used=True,
+                                                           top_k=top_k)
+    if args.problem_type == 'sat':
+        x_proj = expand_variables(x_proj, rows, batch)
+
+    # ENSURE we are getting a +/- 1 vector out by replacing 0 with 1
+    x_proj = torch.where(x_proj == 0, 1, x_proj)
+
+    if refine:
+        refinement = getattr(args, 'refinement', 'greedy')
+        steps = getattr(args, 'refine_steps', 1000)
+        if refinement == 'greedy':
+            candidates = batch_local_search(args, x_proj, batch)
+            scores = problem.batch_score(args, candidates[:, :, None], batch)
+        elif refinement == 'tabu':
+            candidates, scores = tabu_search(args, x_proj, batch, problem.batch_score, steps=steps,
+                                             tenure=getattr(args, 'tabu_tenure', 10))
+        elif refinement == 'annealing':
+            candidates, scores = parallel_tempering(args, x_proj, batch, problem.batch_score, steps=steps,
+                                                    temperatures=getattr(args, 'temperatures', 8))
+        elif refinement == 'walksat':
+            candidates, _ = walksat(args, x_proj, batch, steps=steps, method=getattr(args, 'walksat_method', 'walksat'))
+            # walksat flips single variables only, so set the pair variables from them again
+            candidates = expand_variables(candidates[:, rows], rows, batch)
+            scores = problem.batch_score(args, candidates[:, :, None], batch)
+        else:
+            raise ValueError(f"Invalid refinement: {refinement}")
+        x_proj, _ = best_candidates(candidates, scores, batch)
+
+    return x_proj, hyperplanes_used
+
+# stack copies of every graph into one batch: copy k of graph g becomes graph k * num_graphs + g
+def replicate_batch(batch, copies):
+    if isinstance(batch, Batch):
+        data_list = batch.to_data_list()
+    else:
+        data_list = [batch]
+
+    # the operator and penalty belong to the original batch; featurize_batch attaches fresh ones
+    data_list = [data.clone() for data in data_list]
+    for data in data_list:
+        for key in ('operator', 'penalty'):
+            if key in data:
+                del data[key]
+    return Batch.from_data_list(data_list * copies)
+
+# run `restarts` random initializations of the model as one forward pass over a replicated batch,
+# round them all together, and keep the best restart for each graph
+# returns the best rounded assignment over the nodes of the original batch, the best score for
+# each graph, and the relaxed loss summed over all restarts
+# if stats is a dict, stats['hyperplanes_used'] is set to the hyperplanes each (restart, graph) was rounded with
+def multi_restart(args, model, batch, problem, restarts=10, stats=None):
+    batch = batch.to(args.device)
+    if isinstance(batch, Batch):
+        num_graphs = batch.num_graphs
+        node_graph = batch.batch
+        ptr = batch.ptr
+    else:
+        num_graphs = 1
+        node_graph = torch.zeros(batch.num_nodes, dtype=torch.long, device=args.device)
+        ptr = torch.tensor([0, batch.num_nodes], device=args.device)
+
+    restart_batch = replicate_batch(batch, restarts)
+    x_in, restart_batch = featurize_batch(args, restart_batch)
+    x_out = run_inference(args, model, x_in, restart_batch)
+    loss = problem.loss(x_out, restart_batch)
+
+    x_proj, hyperplanes_used = round_batch(args, x_out, restart_batch, problem)
+    if stats is not None:
+        stats['hyperplanes_used'] = hyperplanes_used.view(restarts, num_graphs)
+
+    # (restarts, graphs) scores, and the best restart for each graph
+    scores, _, constraints = problem.evaluate(args, x_proj, restart_batch)
+    scores = scores.view(restarts, num_graphs)
+    best_scores, best = scores.max(dim=0)
+    if stats is not None:
+        stats['constraints'] = constraints.view(restarts, num_graphs).gather(0, best[None])[0]
+
+    # node i of graph g is found at the same offset within copy best[g] of graph g
+    offset = torch.arange(batch.num_nodes, device=args.device) - ptr[node_graph]
+    restart_graph = best[node_graph] * num_graphs + node_graph
+    x_best = x_proj[restart_batch.ptr[restart_graph] + offset]
+
+    return x_best, best_scores, loss
+
 # measure and return the validation loss
 def validate(args, model, val_loader, problem):
     total_loss = 0.
     total_score = 0.
     total_constraint = 0.
     total_count = 0
+    total_satisfied = 0.
+    total_clauses = 0.
     with torch.no_grad():
         for batch in val_loader:
-            if len(batch) == 1:
-                datalist = [batch]
-            else:
-                datalist = batch.to_data_list()
-
             x_in, batch = featurize_batch(args, batch)
-            x_out = model(x_in, batch)
+            x_out = run_inference(args, model, x_in, batch)
             loss = problem.loss(x_out, batch)
 
             total_loss += float(loss)
 
-            x_proj = random_hyperplane_projector(args, x_out, batch, problem.score)
-
-            # ENSURE we are getting a +/- 1 vector out by replacing 0 with 1
-            x_proj = torch.where(x_proj == 0, 1, x_proj)
+            x_proj, _ = round_batch(args, x_out, batch, problem)
 
             num_zeros = (x_proj == 0).count_nonzero()
             assert num_zeros == 0
 
-            # count the score
-            score = problem.score(args, x_proj, batch)
-            total_score += float(score)
-            total_constraint += float(problem.constraint(x_proj, batch))
+            # score and constraint of every graph in the batch, from one evaluation
+            score, _, constraint = problem.evaluate(args, x_proj, batch)
+            total_score += float(score.sum())
+            total_constraint += float(constraint.sum())
+
+            # exact MAX-SAT counts: the score of a rounded assignment is its satisfied clause count
+            if args.problem_type == 'sat':
+                total_satisfied += float(score.sum())
+                total_clauses += float(torch.as_tensor(batch.num_clauses).sum())
 
             total_count += len(batch)
 
+    if total_clauses > 0:
+        print(f"  satisfied clauses: {total_satisfied / total_count:0.2f} per formula ({total_satisfied / total_clauses:0.4f} of clauses)")
+
     return total_loss / total_count, total_score / total_count, total_constraint / total_count
 
 def train(args, model, train_loader, optimizer, problem, val_loader=None, test_loader=None):
@@ -98,6 +248,10 @@ def train(args, model, train_loader, optimizer, problem, val_loader=None, test_l
 
     model.to(args.device)
 
+    loss_fn = problem.loss
+    if getattr(args, 'compile', False):
+        loss_fn = maybe_compile(loss_fn)
+
     ep = 0
     steps = 0
 
@@ -111,10 +265,11 @@ def train(args, model, train_loader, optimizer, problem, val_loader=None, test_l
         for batch in train_loader:
             # run the model
             x_in, batch = featurize_batch(args, batch)
-            x_out = model(x_in, batch)
+            with precision_context(args):
+                x_out = model(x_in, batch)
 
-            # get loss
-            loss = problem.loss(x_out, batch)
+            # get loss, in fp32
+            loss = loss_fn(x_out.float(), batch)
 
             # run gradient descent step
             optimizer.zero_grad()
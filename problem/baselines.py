@@ -4,13 +4,17 @@ import cvxpy as cp
 import gurobipy as gp
 from gurobipy import GRB
 import numpy as np
+import time
 import torch
 import torch.nn.functional as F
 from torch_geometric.utils import to_dense_adj, to_torch_csr_tensor, to_networkx
-from torch_geometric.data import Batch
 import networkx as nx
 import mosek
 
+from problem.operators import get_operator, select_graphs
+from problem.bitpack import packed_hyperplane_signs
+from problem.local_search import tabu_search, parallel_tempering, best_candidates
+
 def max_cut_sdp(args, example):
     N = example.num_nodes
     edge_index = example.edge_index
@@ -123,73 +127,221 @@ def e1_projector(args, x_lift, example, score_fn):
         x_lift = torch.FloatTensor(x_lift)
     return torch.sign(x_lift[:, 0, None])
 
+# returns sample(n), drawing n unit hyperplanes of dimension dim for rounding; kind is one of
+#   gaussian: i.i.d. Gaussian directions
+#   orthogonal: blocks of dim mutually orthogonal directions, from the QR decomposition of a Gaussian matrix
+#   sobol: scrambled Sobol points mapped through the inverse normal CDF, covering the sphere more evenly
+#   antithetic: Gaussian directions in (h, -h) pairs. for max cut, -h gives the same cut as h
+# draws continue the same sequence across calls to sample
+def hyperplane_sampler(kind, dim, device):
+    if kind == 'gaussian':
+        def sample(n):
+            return F.normalize(torch.randn((n, dim), device=device))
+    elif kind == 'orthogonal':
+        def sample(n):
+            blocks = []
+            for _ in range((n + dim - 1) // dim):
+                q, r = torch.linalg.qr(torch.randn((dim, dim), device=device))
+                # fix the signs so that each block is a uniformly random rotation
+                q = q * torch.sign(torch.diagonal(r))
+                blocks.append(q.t())
+            return torch.cat(blocks)[:n]
+    elif kind == 'sobol':
+        # seed from torch's generator, so that torch.manual_seed still fixes the draws
+        engine = torch.quasirandom.SobolEngine(dimension=dim, scramble=True, seed=int(torch.randint(2**31 - 1, ())))
+        def sample(n):
+            u = engine.draw(n).clamp(1e-6, 1 - 1e-6)
+            return F.normalize(torch.special.ndtri(u)).to(device)
+    elif kind == 'antithetic':
+        def sample(n):
+            half = F.normalize(torch.randn(((n + 1) // 2, dim), device=device))
+            return torch.cat((half, -half))[:n]
+    else:
+        raise ValueError(f"Invalid hyperplane sampler: {kind}")
+    return sample
+
 # returns a torch.FloatTensor size (N,)
-# n_hyperplanes: how many to try?
-# n_groups: we may do it in groups to reduce memory consumption; how many?
-def random_hyperplane_projector(args, x_lift, batch, score_fn, n_hyperplanes=1000, n_groups=1):
+# rounds the whole batch at once: every hyperplane is applied to every graph, and each graph keeps its best one
+# hyperplanes are streamed in groups, and only the running best assignment and score of each graph are kept,
+# so memory does not grow with n_hyperplanes
+# score_fn: per-graph scorer, taking (hyperplanes, N, 1) assignments to (hyperplanes, graphs) scores,
+#   e.g. problem.batch_score
+# n_hyperplanes: how many to try? they are drawn by hyperplane_sampler(args.hyperplane_sampler)
+# n_groups: how many groups to stream them in; by default, as few as fit in args.rounding_memory_budget,
+#   but with patience or a time_budget, groups are capped so those checks run between them
+# packed_score_fn: if given, e.g. problem.packed_score, each group is kept bit-packed (see problem/bitpack.py)
+#   and scored with it, so a group costs one bit per node and hyperplane instead of a float
+# patience: if set, a graph stops drawing hyperplanes once this many in a row haven't improved its best score
+# time_budget: if set, rounding stops after the first group that ends past this many seconds
+# return_used: also return the number of hyperplanes each graph was rounded with
+# top_k: if set, keep the k best assignments of each graph instead of one, and return them as (k, N)
+def random_hyperplane_projector(args, x_lift, batch, score_fn, n_hyperplanes=1000, n_groups=None, packed_score_fn=None,
+                                patience=None, time_budget=None, return_used=False, top_k=None):
     if isinstance(x_lift, np.ndarray):
         x_lift = torch.FloatTensor(x_lift)
 
-    #torch.cuda.memory._record_memory_history(enabled=True, trace_alloc_max_entries=100000, trace_alloc_record_context=True)
-    x_int = []
-    scores = []
-    for i in range(n_groups):
-        hyper = torch.randn((n_hyperplanes // n_groups, x_lift.shape[1]), device=x_lift.device)
-        hyper = F.normalize(hyper)
-        x_proj = torch.matmul(hyper, x_lift.t())
-
-        # group_x_int[i, j] is the assignment for hyperplane i, variable j
-        group_x_int = torch.sign(x_proj)[:, :, None]
-        x_int.append(group_x_int)
-
-        group_scores = []
-
-        if isinstance(batch, Batch):
-            # here we score on each component of the batch individually
-            for i, example in enumerate(batch.to_data_list()):
-                # slice out this example's nodes
-                example_x_int = group_x_int[:, batch.ptr[i]:batch.ptr[i + 1], :]
-
-                # XXX the penalty hack here is not ok under many conditions!
-                example.penalty = batch.penalty
+    op = get_operator(batch)
+    sample = hyperplane_sampler(getattr(args, 'hyperplane_sampler', 'gaussian'), x_lift.shape[1], x_lift.device)
 
-                # compute scores for _all_ hyperplanes and _only_ this example
-                group_example_scores = torch.vmap(lambda x: score_fn(args, x, example))(example_x_int)
-                group_scores.append(group_example_scores)
+    if packed_score_fn is None:
+        if n_groups is None:
+            group_size = rounding_group_size(args, op, x_lift.element_size())
         else:
-            # we are compatible with single-example hyperplane rounding
-            group_example_scores = torch.vmap(lambda x: score_fn(args, x, batch))(group_x_int)
-            group_scores.append(group_example_scores)
+            group_size = n_hyperplanes // n_groups
 
-        # stack these scores to form a (hyperplanes x graphs) tensor
-        group_scores = torch.stack(group_scores, dim=1)
-        scores.append(group_scores)
-
-    x_int = torch.cat(x_int, dim=0) # now (n_hyperplanes x nodes_in_batch x 1)
-    scores = torch.cat(scores, dim=0) # now (n_hyperplanes x graphs_in_batch)
+        # group_x_int[i, j] is the assignment for hyperplane i, variable j
+        def round_group(hyper, x_lift, batch):
+            group_x_int = torch.sign(torch.matmul(hyper, x_lift.t()))[:, :, None]
 
-    best = torch.argmax(scores, dim=0) # now (graphs_in_batch), best hyperplane index for each graph
+            # (hyperplanes x graphs) scores for the whole batch in one call
+            group_scores = score_fn(args, group_x_int, batch)
 
-    out = []
-    if isinstance(batch, Batch):
-        for i in range(len(batch)):
-            out.append(x_int[best[i], batch.ptr[i]:batch.ptr[i + 1], 0])
+            # the assignment of each node under its graph's chosen hyperplane in best
+            nodes = torch.arange(x_lift.shape[0], device=x_lift.device)
+            def assign(best):
+                return group_x_int[best[get_operator(batch).node_graph], nodes, 0]
+            return group_scores, assign
     else:
-        out.append(x_int[best[0], :, 0])
-    out = torch.cat(out, dim=0)
+        memory_budget = rounding_memory_budget(args)
+        if n_groups is None:
+            # half the budget goes to the packed group, a quarter each to the node blocks of the projection
+            # and the edge chunks of the scorer
+            group_size = max(1, int(memory_budget // 2 // (8 * op.bit_layout.num_words)))
+        else:
+            group_size = n_hyperplanes // n_groups
+        group_size = min(group_size, n_hyperplanes)
+        # float projection, sign, and int64 shifted bits per node
+        block_size = max(1, int(memory_budget // 4 // (17 * group_size)))
+        # a few int64 gathers and a float weight per edge or clause
+        chunk_size = max(1, int(memory_budget // 4 // (40 * group_size)))
+
+        # group_words[i] packs the assignment for hyperplane i
+        def round_group(hyper, x_lift, batch):
+            sub_op = get_operator(batch)
+            layout = sub_op.bit_layout
+            group_words = packed_hyperplane_signs(layout, hyper, x_lift, block_size)
+            group_scores = packed_score_fn(args, group_words, batch, chunk_size=chunk_size)
+
+            # each node reads its bit from its own graph's chosen words
+            def assign(best):
+                bits = (group_words[best[sub_op.node_graph], layout.word] >> layout.bit) & 1
+                return 2. * bits.float() - 1.
+            return group_scores, assign
+
+    out, used = stream_hyperplanes(x_lift, batch, sample, round_group, n_hyperplanes, group_size, patience, time_budget,
+                                   top_k=1 if top_k is None else top_k)
+    if top_k is None:
+        out = out[0]
 
     num_zeros = (out == 0).count_nonzero()
     if num_zeros > 0:
         print("WARNING: detected zeros in hyperplane rounding output")
 
-    #import pickle
-    #pickle.dump(torch.cuda.memory._snapshot(), open('snapshot.pickle', 'wb'))
-    #torch.cuda.memory._record_memory_history(enabled=None)
-    #exit(0)
-
+    if return_used:
+        return out, used
     return out
 
+# with a time budget, hyperplanes are streamed in at least this many groups
+TIME_BUDGET_ROUNDS = 10
+
+# the keep-best loop behind random_hyperplane_projector
+# round_group(hyper, x_lift, batch) returns the (hyperplanes x graphs) scores of a group, and a function
+# taking a chosen hyperplane per graph to the assignment of every node
+# keeps the top_k best assignments of each graph as (top_k, N), best first
+# once a graph has run out of patience, later groups are drawn only for a sub-batch of the remaining graphs
+def stream_hyperplanes(x_lift, batch, sample, round_group, n_hyperplanes, group_size, patience=None, time_budget=None,
+                       top_k=1):
+    op = get_operator(batch)
+    device = x_lift.device
+    start_time = time.time()
+
+    # patience and the time budget are checked between groups, so keep groups small enough for them to stop rounding
+    if patience is not None:
+        group_size = min(group_size, max(1, patience))
+    if time_budget is not None:
+        group_size = min(group_size, max(1, -(-n_hyperplanes // TIME_BUDGET_ROUNDS)))
+
+    best_scores = torch.full((top_k, op.num_graphs), -torch.inf, device=device)
+    used = torch.zeros(op.num_graphs, dtype=torch.long, device=device)
+    since_improved = torch.zeros(op.num_graphs, dtype=torch.long, device=device)
+    out = torch.zeros((top_k, x_lift.shape[0]), device=device)
+
+    # the still-active graphs, and the positions of their nodes in x_lift
+    active = torch.arange(op.num_graphs, device=device)
+    node_index = torch.arange(x_lift.shape[0], device=device)
+    for start in range(0, n_hyperplanes, group_size):
+        h = min(group_size, n_hyperplanes - start)
+        group_scores, assign = round_group(sample(h), x_lift, batch)
+
+        # merge the group into the running top k of each graph: picks below top_k are kept rows,
+        # the rest are hyperplanes of this group. kept rows come first, so they win ties
+        new_scores, picks = torch.topk(torch.cat((best_scores[:, active], group_scores)), top_k, dim=0)
+        improved = new_scores[0] > best_scores[0, active]
+
+        node_graph = get_operator(batch).node_graph
+        rows = []
+        for pick in picks:
+            kept = out[pick.clamp(max=top_k - 1)[node_graph], node_index]
+            fresh = assign((pick - top_k).clamp(min=0))
+            rows.append(torch.where((pick >= top_k)[node_graph], fresh, kept))
+        out[:, node_index] = torch.stack(rows)
+        best_scores[:, active] = new_scores
+
+        used[active] += h
+        since_improved[active] = torch.where(improved, 0, since_improved[active] + h)
+
+        if time_budget is not None and time.time() - start_time > time_budget:
+            break
+        if patience is None:
+            continue
+
+        done = since_improved[active] >= patience
+        if done.all():
+            break
+        if done.any():
+            keep = (~done).nonzero().flatten()
+            node_mask = ~done[node_graph]
+            active = active[keep]
+            node_index = node_index[node_mask]
+            x_lift = x_lift[node_mask]
+            batch = select_graphs(batch, keep)
+
+    return out, used
+
+# args.rounding_memory_budget, in bytes
+def rounding_memory_budget(args):
+    memory_budget = getattr(args, 'rounding_memory_budget', None)
+    if memory_budget is None:
+        memory_budget = 1024
+    return memory_budget * 2**20
+
+# how many hyperplanes can be rounded and scored at once within args.rounding_memory_budget?
+# per hyperplane we hold the projection and assignment over the nodes, plus the scorer's edge-level gathers
+def rounding_group_size(args, op, element_size=4):
+    bytes_per_hyperplane = element_size * (2 * op.num_nodes + 3 * op.num_edges)
+    return max(1, int(rounding_memory_budget(args) // bytes_per_hyperplane))
+
+# returns a torch.FloatTensor size (N,)
+# runs `chains` tabu search chains per graph, seeded with the best hyperplane roundings of x_lift
+def tabu_projector(args, x_lift, batch, score_fn, chains=16):
+    X = random_hyperplane_projector(args, x_lift, batch, score_fn, top_k=chains)
+    X, scores = tabu_search(args, X, batch, score_fn, steps=getattr(args, 'refine_steps', 1000),
+                            tenure=getattr(args, 'tabu_tenure', 10))
+    return best_candidates(X, scores, batch)[0]
+
+# returns a torch.FloatTensor size (N,)
+# runs `chains` parallel tempering chains per graph, seeded with the best hyperplane roundings of x_lift,
+# each replicated across the temperatures
+def annealing_projector(args, x_lift, batch, score_fn, chains=16):
+    temperatures = getattr(args, 'temperatures', 8)
+    X = random_hyperplane_projector(args, x_lift, batch, score_fn, top_k=max(1, chains // temperatures))
+    X, scores = parallel_tempering(args, X, batch, score_fn, steps=getattr(args, 'refine_steps', 1000),
+                                   temperatures=temperatures)
+    return best_candidates(X, scores, batch)[0]
+
 # expect a (N,) shaped x_proj, all +/- 1. will tolerate 0 entries
+# score_fn: per-graph scorer as in random_hyperplane_projector, e.g. problem.batch_score;
+#   each block of batch_sz flipped versions is scored in one call
 def generic_greedy(args, x_proj, example, score_fn, batch_sz=64, iterations=1000):
     if isinstance(x_proj, np.ndarray):
         x_proj = torch.FloatTensor(x_proj)
@@ -198,7 +350,7 @@ def generic_greedy(args, x_proj, example, score_fn, batch_sz=64, iterations=1000
 
     # TODO make number of iterations adjustable from arguments
     flip_matrix = torch.ones(N, N, device=args.device) - 2 * torch.diag(torch.ones(N, device=args.device))
-    current_score = score_fn(args, x_proj, example)
+    current_score = score_fn(args, x_proj[:, None], example)[0]
     for i in range(iterations):
         # spam out N versions
         versions = x_proj.repeat(N, 1) # (N, N) where each row versions[i] is a copy of x_proj
@@ -210,13 +362,13 @@ def generic_greedy(args, x_proj, example, score_fn, batch_sz=64, iterations=1000
         scores = []
         for batch_idx in range(0, N, batch_sz):
             version_slice = versions[batch_idx : min(batch_idx + batch_sz, N)]
-            batch_scores = torch.vmap(lambda x: score_fn(args, x, example))(version_slice)
+            batch_scores = score_fn(args, version_slice[:, :, None], example)[:, 0]
             scores.append(batch_scores)
         scores = torch.cat(scores)
         best = torch.argmax(scores)
-        if best > current_score:
+        if scores[best] > current_score:
             # set the new current x_proj
-            current_score = best
+            current_score = scores[best]
             x_proj = versions[best, :]
         else:
             # no version was better
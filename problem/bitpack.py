@@ -0,0 +1,90 @@
+# Bit-packed +/- 1 assignments
+# a block of candidate assignments (..., N) is stored as (..., num_words) int64 words, one bit per variable:
+# the bit is 1 where the variable is +1. every graph starts on a fresh word, so per-graph counts are
+# popcounts of whole words, and padding bits are always 0
+
+import torch
+from torch_geometric.utils import scatter
+
+WORD_BITS = 64
+
+# SWAR popcount of each int64 word
+# torch shifts signed ints arithmetically, but every shifted value is masked before the copied sign
+# bits can matter, and the final byte sum is at most 64, so the results are exact
+def popcount(words):
+    words = words - ((words >> 1) & 0x5555555555555555)
+    words = (words & 0x3333333333333333) + ((words >> 2) & 0x3333333333333333)
+    words = (words + (words >> 4)) & 0x0F0F0F0F0F0F0F0F
+    return (words * 0x0101010101010101) >> 56
+
+# where each node's bit lives, for the nodes of a GraphOperator
+class BitLayout():
+    def __init__(self, op):
+        device = op.node_graph.device
+        sizes = scatter(torch.ones(op.num_nodes, dtype=torch.long, device=device), op.node_graph,
+                        dim=0, dim_size=op.num_graphs, reduce='sum')
+        node_start = torch.cumsum(sizes, dim=0) - sizes
+        graph_words = (sizes + WORD_BITS - 1) // WORD_BITS
+        word_start = torch.cumsum(graph_words, dim=0) - graph_words
+
+        local = torch.arange(op.num_nodes, device=device) - node_start[op.node_graph]
+        self.word = word_start[op.node_graph] + local // WORD_BITS
+        self.bit = local % WORD_BITS
+
+        self.num_nodes = op.num_nodes
+        self.num_graphs = op.num_graphs
+        self.num_words = int(graph_words.sum())
+        self.word_graph = torch.repeat_interleave(torch.arange(op.num_graphs, device=device), graph_words)
+
+    # (..., N) booleans -> (..., num_words) words
+    # nodes may be a subset of the nodes, in which case bits holds just their values
+    def pack(self, bits, nodes=None, out=None):
+        word = self.word if nodes is None else self.word[nodes]
+        bit = self.bit if nodes is None else self.bit[nodes]
+        if out is None:
+            out = torch.zeros(bits.shape[:-1] + (self.num_words,), dtype=torch.long, device=bits.device)
+
+        # bits within a word are distinct powers of two, so summing them never carries
+        values = bits.long() << bit
+        return out.scatter_add_(-1, word.expand_as(values), values)
+
+    # the bits (..., len(nodes)) of the given nodes, as 0/1 int64
+    def gather(self, words, nodes=None):
+        word = self.word if nodes is None else self.word[nodes]
+        bit = self.bit if nodes is None else self.bit[nodes]
+        return (words[..., word] >> bit) & 1
+
+    # number of set bits in each graph, (..., num_graphs)
+    def count(self, words):
+        return scatter(popcount(words), self.word_graph, dim=-1, dim_size=self.num_graphs, reduce='sum')
+
+# the sign patterns of x_lift (N, r) against each of the hyperplanes (H, r), packed to (H, num_words)
+# projections are computed block_size nodes at a time, so the (H, N) float projection never exists at once
+def packed_hyperplane_signs(layout, hyper, x_lift, block_size=None):
+    N = x_lift.shape[0]
+    if block_size is None:
+        block_size = N
+
+    out = torch.zeros((hyper.shape[0], layout.num_words), dtype=torch.long, device=x_lift.device)
+    for start in range(0, N, block_size):
+        end = min(start + block_size, N)
+        x_proj = torch.matmul(hyper, x_lift[start:end].t())
+        nodes = torch.arange(start, end, device=x_lift.device)
+        layout.pack(x_proj > 0, nodes=nodes, out=out)
+    return out
+
+# 0/1 per candidate and edge: do the endpoints src[e], dst[e] take different values?
+def packed_edge_cut(layout, words, src, dst):
+    return layout.gather(words, src) ^ layout.gather(words, dst)
+
+# 0/1 per candidate and edge: are both endpoints -1?
+def packed_edge_uncovered(layout, words, src, dst):
+    return (layout.gather(words, src) | layout.gather(words, dst)) ^ 1
+
+# 0/1 per candidate and clause: is at least one literal true?
+# clause_vars: (3, K) node index of each literal; negated: (K, 3) whether each literal is negated
+def packed_clause_sat(layout, words, clause_vars, negated):
+    sat = 0
+    for j in range(clause_vars.shape[0]):
+        sat = sat | (layout.gather(words, clause_vars[j]) ^ negated[:, j].long())
+    return sat
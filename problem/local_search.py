@@ -0,0 +1,206 @@
+# Local search over rounded +/- 1 assignments, as a post-processing step after hyperplane rounding
+#
+# for max cut and vertex cover, the change in score from flipping x_u is gain_u = x_u * f_u,
+# where the field f = b + K x for a per-problem vector b and symmetric sparse K without self loops:
+#   max cut: b = 0, K = A + A^T with edge weights, since the score is (E - x^T A x) / 2
+#   vertex cover: b = w - 2 M 1, K = 2 M, with M = A + A^T counting edge multiplicity,
+#     since covering u gains 4 per uncovered edge at u and costs w_u
+# flipping u changes f only on u's neighbors, so each flip costs O(degree(u)) to apply, and the engines
+# below apply a whole step of flips, across graphs and candidates, with one gather over their CSR rows
+
+import torch
+from torch_geometric.utils import scatter, spmm
+
+from problem.operators import get_operator
+
+# K (as CSR) and b for the problem being solved
+def flip_system(args, batch):
+    op = get_operator(batch)
+    if args.problem_type == 'max_cut':
+        K = op.symmetric_csr(op.edge_weight, without_self_loops=True)
+        b = torch.zeros(op.num_nodes, device=op.src.device)
+    elif args.problem_type == 'vertex_cover':
+        multiplicity = op.edge_multiplicity
+        if multiplicity is None:
+            multiplicity = torch.ones(op.num_edges, device=op.src.device)
+        K = op.symmetric_csr(2. * multiplicity.float(), without_self_loops=True)
+        b = op.node_weight - spmm(K, torch.ones((op.num_nodes, 1), device=op.src.device))[:, 0]
+    else:
+        raise ValueError(f"No flip local search for problem_type {args.problem_type}")
+    return K, b
+
+# can local_search refine assignments for this problem?
+def has_local_search(args):
+    return args.problem_type in ('max_cut', 'vertex_cover')
+
+# the largest of values (C, M) in each (row, segment) for segments given by index (M,), and the first position
+# attaining it: (C, num_segments) each. empty segments get -inf
+def segment_argmax(values, index, num_segments):
+    positions = torch.arange(values.shape[-1], device=values.device)
+    segment_max = scatter(values, index, dim=-1, dim_size=num_segments, reduce='max')
+    first = torch.where(values == segment_max[:, index], positions, values.shape[-1])
+    first = scatter(first, index, dim=-1, dim_size=num_segments, reduce='min')
+
+    sizes = scatter(torch.ones_like(positions), index, dim=0, dim_size=num_segments, reduce='sum')
+    segment_max = torch.where(sizes > 0, segment_max, -torch.inf)
+    return segment_max, first
+
+# flip X[candidate[i], u[i]] for each i, at most once per (candidate, graph), updating the fields to match
+# X and field are updated in place. flipping u moves each neighbor v's field by -2 K_vu x_u, so only the CSR rows of the flipped u are read
+def apply_flips(X, field, K, candidate, u):
+    crow, col, val = K.crow_indices(), K.col_indices(), K.values()
+    start = crow[u]
+    degree = crow[u + 1] - start
+
+    # position in col/val of every neighbor of every flip, and the flip it belongs to
+    flip = torch.repeat_interleave(torch.arange(len(u), device=X.device), degree)
+    first = torch.cumsum(degree, dim=0) - degree
+    position = start[flip] + torch.arange(len(flip), device=X.device) - first[flip]
+
+    deltas = -2. * val[position] * X[candidate[flip], u[flip]]
+    field.index_put_((candidate[flip], col[position]), deltas, accumulate=True)
+    X[candidate, u] = -X[candidate, u]
+    return X, field
+
+# one-flip local search on a stack of candidate assignments X (C, N) over a whole batch at once
+# each sweep flips, in every (candidate, graph) pair, the variable with the largest gain if it is above tol;
+# flips in different graphs or candidates never interact, so a sweep updates all fields in one apply_flips
+# stops once no pair can improve, or after max_sweeps sweeps. returns the refined (C, N) assignments
+def batch_local_search(args, X, batch, max_sweeps=None, tol=1e-6):
+    if not has_local_search(args):
+        return X
+
+    op = get_operator(batch)
+    K, b = flip_system(args, batch)
+
+    X = torch.where(X == 0, 1., X.float())
+    field = b + spmm(K, X.t()).t()
+
+    sweeps = 0
+    while max_sweeps is None or sweeps < max_sweeps:
+        graph_gains, flip_node = segment_argmax(X * field, op.node_graph, op.num_graphs)
+
+        improving = graph_gains > tol
+        if not improving.any():
+            break
+
+        candidate, graph = improving.nonzero(as_tuple=True)
+        X, field = apply_flips(X, field, K, candidate, flip_node[candidate, graph])
+        sweeps += 1
+
+    return X
+
+# tabu search on a stack of chains X (C, N), each chain covering every graph of the batch
+# every step flips the best-gain variable of each (chain, graph) that isn't tabu, even if that makes it worse;
+# a flipped variable stays tabu for `tenure` steps, unless flipping it back would beat the chain's best
+# score_fn: per-graph scorer for the starting scores, e.g. problem.batch_score
+# returns the best assignments (C, N) each chain visited, and their (C, num_graphs) scores
+def tabu_search(args, X, batch, score_fn, steps=1000, tenure=10, tol=1e-6):
+    X = torch.where(X == 0, 1., X.float())
+    scores = score_fn(args, X[:, :, None], batch)
+    if not has_local_search(args):
+        return X, scores
+
+    op = get_operator(batch)
+    K, b = flip_system(args, batch)
+    field = b + spmm(K, X.t()).t()
+
+    best_X, best_scores = X.clone(), scores
+    tabu_until = torch.zeros(X.shape, dtype=torch.long, device=X.device)
+    for step in range(steps):
+        gains = X * field
+
+        # aspiration: a tabu move is allowed if it reaches a new best for its chain and graph
+        aspires = scores[:, op.node_graph] + gains > best_scores[:, op.node_graph] + tol
+        allowed = (tabu_until <= step) | aspires
+        graph_gains, flip_node = segment_argmax(torch.where(allowed, gains, -torch.inf), op.node_graph, op.num_graphs)
+
+        moving = graph_gains > -torch.inf
+        candidate, graph = moving.nonzero(as_tuple=True)
+        u = flip_node[candidate, graph]
+        X, field = apply_flips(X, field, K, candidate, u)
+        tabu_until[candidate, u] = step + 1 + tenure
+        scores = scores + torch.where(moving, graph_gains, 0.)
+
+        improved = scores > best_scores + tol
+        best_scores = torch.where(improved, scores, best_scores)
+        best_X = torch.where(improved[:, op.node_graph], X, best_X)
+
+    return best_X, best_scores
+
+# parallel-tempering simulated annealing seeded with a stack of assignments X (k, N), each covering every graph
+# every seed is replicated across the temperature ladder, giving C = k * temperatures chains; chain c runs at
+# inverse temperature betas[c % temperatures], geometrically spaced from beta_min to beta_max
+# every step proposes one uniformly random flip per (chain, graph), accepted with probability exp(beta * gain);
+# every swap_every steps, neighbouring temperatures of each graph exchange assignments with the usual
+# replica exchange probability exp((beta_i - beta_j) (score_j - score_i))
+# score_fn: per-graph scorer for the starting scores, e.g. problem.batch_score
+# returns the best assignments (C, N) each chain visited, and their (C, num_graphs) scores
+def parallel_tempering(args, X, batch, score_fn, steps=1000, temperatures=8, beta_min=0.1, beta_max=10.,
+                       swap_every=10, tol=1e-6):
+    X = torch.where(X == 0, 1., X.float()).repeat_interleave(temperatures, dim=0)
+    scores = score_fn(args, X[:, :, None], batch)
+    if not has_local_search(args):
+        return X, scores
+
+    op = get_operator(batch)
+    K, b = flip_system(args, batch)
+    field = b + spmm(K, X.t()).t()
+
+    C = X.shape[0]
+    device = X.device
+    ladder = torch.logspace(torch.log10(torch.tensor(beta_min)), torch.log10(torch.tensor(beta_max)), temperatures)
+    level = torch.arange(C, device=device) % temperatures
+    betas = ladder.to(device)[level]
+
+    # node ranges of each graph, for drawing proposals
+    sizes = scatter(torch.ones(op.num_nodes, dtype=torch.long, device=device), op.node_graph,
+                    dim=0, dim_size=op.num_graphs, reduce='sum')
+    starts = torch.cumsum(sizes, dim=0) - sizes
+    has_nodes = sizes > 0
+    nodes = torch.arange(op.num_nodes, device=device)
+    rows = torch.arange(C, device=device)
+
+    best_X, best_scores = X.clone(), scores
+    for step in range(steps):
+        u = starts + (torch.rand((C, op.num_graphs), device=device) * sizes).long().clamp(max=sizes - 1)
+        u = u.clamp(min=0, max=op.num_nodes - 1)
+        gains = X.gather(1, u) * field.gather(1, u)
+        accept = (torch.rand_like(gains) < torch.exp(betas[:, None] * gains)) & has_nodes
+
+        candidate, graph = accept.nonzero(as_tuple=True)
+        X, field = apply_flips(X, field, K, candidate, u[candidate, graph])
+        scores = scores + torch.where(accept, gains, 0.)
+
+        improved = scores > best_scores + tol
+        best_scores = torch.where(improved, scores, best_scores)
+        best_X = torch.where(improved[:, op.node_graph], X, best_X)
+
+        if (step + 1) % swap_every == 0:
+            # pair levels (l, l + 1) starting from alternating parities
+            parity = (step + 1) // swap_every % 2
+            lower = (level % 2 == parity) & (level + 1 < temperatures)
+            lower_rows = rows[lower]
+            upper_rows = lower_rows + 1
+            swap_prob = torch.exp((betas[lower_rows, None] - betas[upper_rows, None]) *
+                                  (scores[upper_rows] - scores[lower_rows]))
+            swap = torch.rand_like(swap_prob) < swap_prob
+
+            # row permutation per graph
+            perm = rows[:, None].expand(C, op.num_graphs).clone()
+            perm[lower_rows] = torch.where(swap, upper_rows[:, None], perm[lower_rows])
+            perm[upper_rows] = torch.where(swap, lower_rows[:, None], perm[upper_rows])
+
+            X = X[perm[:, op.node_graph], nodes]
+            field = field[perm[:, op.node_graph], nodes]
+            scores = scores.gather(0, perm)
+
+    return best_X, best_scores
+
+# pick the best of C candidate assignments X (C, N) for each graph, given their (C, num_graphs) scores
+# returns the (N,) assignment and (num_graphs,) scores
+def best_candidates(X, scores, batch):
+    node_graph = get_operator(batch).node_graph
+    best_scores, best = scores.max(dim=0)
+    nodes = torch.arange(X.shape[1], device=X.device)
+    return X[best[node_graph], nodes], best_scores
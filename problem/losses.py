@@ -5,49 +5,94 @@ import time
 
 import torch
 import torch.nn.functional as F
-from torch_geometric.utils import dense_to_sparse, to_dense_adj, to_torch_csr_tensor, to_torch_coo_tensor
+from torch_geometric.utils import dense_to_sparse, to_dense_adj, to_torch_csr_tensor, to_torch_coo_tensor, scatter
 from functools import partial
 
+from problem.operators import get_operator
+from problem.bitpack import packed_edge_cut, packed_edge_uncovered
+
 # X should have shape (N, r)
 def max_cut_obj(X, batch):
-    # attach edge weights if they're not already present
-    if not hasattr(batch, 'edge_weight') or batch.edge_weight is None:
-        num_edges = batch.edge_index.shape[1]
-        batch.edge_weight = torch.ones(num_edges, device=X.device)
-
-    # compute loss
-    X0 = X[batch.edge_index[0]]
-    X1 = X[batch.edge_index[1]]
-    edges = torch.sum(X0 * X1, dim=1)
-    obj = torch.sum(edges * batch.edge_weight)
+    op = get_operator(batch)
+
+    # compute loss, in chunks of edges if there is a memory budget
+    def edge_sum(start, end):
+        X0 = X[op.src[start:end]]
+        X1 = X[op.dst[start:end]]
+        edges = torch.sum(X0 * X1, dim=1)
+        return torch.sum(edges * op.edge_weight[start:end])
+
+    bytes_per_edge = 3 * X.shape[1] * X.element_size()
+    obj = op.chunked_sum(edge_sum, op.num_edges, bytes_per_edge, X.requires_grad)
     return obj
 
+# gradient of max_cut_obj w.r.t. X, i.e. (A + A^T) X
+# each edge (i, j) sends w_ij x_j to i and w_ij x_i to j
+def max_cut_grad(X, batch):
+    return get_operator(batch).matmul(X)
+
 def vertex_cover_obj(X, batch):
-    # attach node weights if they're not already present
-    N = batch.num_nodes
-    if not hasattr(batch, 'node_weight') or batch.node_weight is None:
-        batch.node_weight = torch.ones(N, device=X.device)
+    op = get_operator(batch)
 
     # lift adopts e1 = (1,0,...,0) as 1
     # count number of vertices: \sum_{i \in [N]} w_i(1+x_i)/2
-    obj = torch.inner(torch.ones(N).to(X.device) + X[:, 0], batch.node_weight) / 2.
+    obj = (torch.sum(op.node_weight) + torch.inner(X[:, 0], op.node_weight)) / 2.
     return obj
 
+# phi_ij = <x_i - e1, x_j - e1> / 2 for each edge (i, j), without materializing x - e1
+def vertex_cover_penalties(X0, X1):
+    return (torch.sum(X0 * X1, dim=-1) - X0[..., 0] - X1[..., 0] + 1.) / 2.
+
 def vertex_cover_constraint(X, batch):
-    N = batch.num_nodes
+    op = get_operator(batch)
 
     # now calculate penalty for uncovered edges
     # phi is matrix of dimension N by N for error per edge
     # phi_ij = 1 - <x_i + x_j,e_1> + <x_i,x_j> for (i,j) \in Edges
     # phi_ij = <x_i - e1, x_j - e1> for (i, j) \in Edges
-    e1 = torch.zeros_like(X) # (num_edges, hidden)
-    e1[:, 0] = 1
-    Xm = X - e1
+    def edge_sum(start, end):
+        penalties = vertex_cover_penalties(X[op.src[start:end]], X[op.dst[start:end]])
+        penalties = penalties * penalties
+        if op.edge_multiplicity is not None:
+            penalties = penalties * op.edge_multiplicity[start:end]
+        return torch.sum(penalties)
 
-    penalties = torch.sum(Xm[batch.edge_index[0]] * Xm[batch.edge_index[1]], dim=1) / 2.
-    constraint = torch.sum(penalties * penalties)
+    bytes_per_edge = 3 * X.shape[1] * X.element_size()
+    constraint = op.chunked_sum(edge_sum, op.num_edges, bytes_per_edge, X.requires_grad)
     return constraint
 
+# gradient of vertex_cover_obj w.r.t. X: w_i / 2 in the e1 coordinate
+def vertex_cover_obj_grad(X, batch):
+    op = get_operator(batch)
+    return F.pad(op.node_weight[:, None] / 2., (0, X.shape[1] - 1))
+
+# gradient of vertex_cover_constraint w.r.t. X
+# d/dx_i phi_ij^2 = phi_ij (x_j - e1), and symmetrically for x_j
+def vertex_cover_constraint_grad(X, batch):
+    op = get_operator(batch)
+    N = X.shape[0]
+
+    def edge_sum(start, end):
+        src = op.src[start:end]
+        dst = op.dst[start:end]
+        X0 = X[src]
+        X1 = X[dst]
+        penalties = vertex_cover_penalties(X0, X1)
+        if op.edge_multiplicity is not None:
+            penalties = penalties * op.edge_multiplicity[start:end]
+
+        index = torch.cat((src, dst))
+        penalties = penalties.repeat(2)
+        messages = torch.cat((X1, X0)) * penalties[:, None]
+        grad = scatter(messages, index, dim=0, dim_size=N, reduce='sum')
+
+        # the -e1 part of (x_j - e1)
+        e1_grad = scatter(penalties, index, dim=0, dim_size=N, reduce='sum')
+        return grad - F.pad(e1_grad[:, None], (0, X.shape[1] - 1))
+
+    bytes_per_edge = 6 * X.shape[1] * X.element_size()
+    return op.chunked_sum(edge_sum, op.num_edges, bytes_per_edge, X.requires_grad)
+
 # we are receiving the _complement_ of the target graph
 # TODO fix this
 def max_clique_loss(X, batch, penalty=2):
@@ -59,8 +104,7 @@ def max_cut_score(args, X, example):
         X = torch.FloatTensor(X)
     if len(X.shape) == 1:
         X = X[:, None]
-    N = example.num_nodes
-    E = example.edge_index.shape[1]
+    E = get_operator(example).num_directed_edges
     return (E - max_cut_obj(X, example)) / 2.
 
 def vertex_cover_score(args, X, example):
@@ -80,3 +124,116 @@ def max_clique_score(args, X, example):
         X = X[:, None]
     N = example.num_nodes
     return N - (vertex_cover_obj(X, example) + vertex_cover_constraint(X, batch))
+
+# Per-graph versions of the objectives, constraints, and scores
+# these reduce over each graph in the batch with segment sums, rather than over the whole batch
+# X may carry leading candidate dimensions: (..., N, r) -> (..., num_graphs)
+
+def max_cut_graph_obj(X, batch):
+    op = get_operator(batch)
+
+    def edge_sum(start, end):
+        X0 = X[..., op.src[start:end], :]
+        X1 = X[..., op.dst[start:end], :]
+        edges = torch.sum(X0 * X1, dim=-1)
+        return op.graph_sum(edges * op.edge_weight[start:end], op.edge_graph[start:end])
+
+    bytes_per_edge = 3 * X[..., 0, :].numel() * X.element_size()
+    return op.chunked_sum(edge_sum, op.num_edges, bytes_per_edge, X.requires_grad)
+
+def vertex_cover_graph_obj(X, batch):
+    op = get_operator(batch)
+    return op.graph_sum(op.node_weight * (1. + X[..., 0]), op.node_graph) / 2.
+
+def vertex_cover_graph_constraint(X, batch):
+    op = get_operator(batch)
+
+    def edge_sum(start, end):
+        penalties = vertex_cover_penalties(X[..., op.src[start:end], :], X[..., op.dst[start:end], :])
+        penalties = penalties * penalties
+        if op.edge_multiplicity is not None:
+            penalties = penalties * op.edge_multiplicity[start:end]
+        return op.graph_sum(penalties, op.edge_graph[start:end])
+
+    bytes_per_edge = 3 * X[..., 0, :].numel() * X.element_size()
+    return op.chunked_sum(edge_sum, op.num_edges, bytes_per_edge, X.requires_grad)
+
+def max_cut_graph_score(args, X, batch):
+    # convert numpy array to torch tensor
+    if isinstance(X, np.ndarray):
+        X = torch.FloatTensor(X)
+    if len(X.shape) == 1:
+        X = X[:, None]
+    E = get_operator(batch).graph_num_directed_edges
+    return (E - max_cut_graph_obj(X, batch)) / 2.
+
+def vertex_cover_graph_score(args, X, batch):
+    # convert numpy array to torch tensor
+    if isinstance(X, np.ndarray):
+        X = torch.FloatTensor(X)
+    if len(X.shape) == 1:
+        X = X[:, None]
+    return - (vertex_cover_graph_obj(X, batch) + vertex_cover_graph_constraint(X, batch))
+
+# max cut scores of a block of +/- 1 assignments S (..., N), or (..., N, 1), in one sparse-dense matmul
+# for each assignment s, sum_ij w_ij s_i s_j = s^T (A + A^T) s / 2, so the whole block needs only (A + A^T) S^T
+# returns (..., num_graphs), equal to max_cut_graph_score on the same assignments
+def max_cut_bulk_score(args, S, batch):
+    if isinstance(S, np.ndarray):
+        S = torch.FloatTensor(S)
+    if len(S.shape) == 1:
+        S = S[:, None]
+    if S.shape[-1] == 1:
+        S = S[..., 0]
+
+    op = get_operator(batch)
+    leading = S.shape[:-1]
+    S = S.reshape(-1, op.num_nodes).float()
+
+    AS = op.matmul(S.t()).t() # (candidates, N)
+    obj = op.graph_sum(S * AS, op.node_graph) / 2.
+
+    E = op.graph_num_directed_edges
+    return ((E - obj) / 2.).reshape(leading + (op.num_graphs,))
+
+# scores of bit-packed assignments (..., num_words) from problem/bitpack.py, (..., num_graphs)
+# edges are visited in chunks of at most chunk_size, so only chunk-sized bit gathers are ever unpacked
+def max_cut_packed_score(args, words, batch, chunk_size=None):
+    op = get_operator(batch)
+    layout = op.bit_layout
+    if chunk_size is None:
+        chunk_size = op.num_edges
+
+    # sum_ij w_ij s_i s_j = W - 2 * (weight of cut edges)
+    cut = 0.
+    for start in range(0, op.num_edges, chunk_size):
+        end = min(start + chunk_size, op.num_edges)
+        edges = packed_edge_cut(layout, words, op.src[start:end], op.dst[start:end])
+        cut = cut + op.graph_sum(edges * op.edge_weight[start:end], op.edge_graph[start:end])
+    obj = op.graph_sum(op.edge_weight, op.edge_graph) - 2. * cut
+
+    E = op.graph_num_directed_edges
+    return (E - obj) / 2.
+
+def vertex_cover_packed_score(args, words, batch, chunk_size=None):
+    op = get_operator(batch)
+    layout = op.bit_layout
+    if chunk_size is None:
+        chunk_size = op.num_edges
+
+    # cover weight: a popcount per graph when nodes are unweighted
+    if bool((op.node_weight == 1).all()):
+        obj = layout.count(words).float()
+    else:
+        obj = op.graph_sum(layout.gather(words) * op.node_weight, op.node_graph)
+
+    # each uncovered edge has penalty ((1 - x_i)(1 - x_j) / 2)^2 = 4
+    uncovered = 0.
+    for start in range(0, op.num_edges, chunk_size):
+        end = min(start + chunk_size, op.num_edges)
+        edges = 4. * packed_edge_uncovered(layout, words, op.src[start:end], op.dst[start:end])
+        if op.edge_multiplicity is not None:
+            edges = edges * op.edge_multiplicity[start:end]
+        uncovered = uncovered + op.graph_sum(edges, op.edge_graph[start:end])
+
+    return - (obj + uncovered)
@@ -0,0 +1,156 @@
+# Sparse operators for a batch of graphs
+# built once per batch in featurize_batch and reused by layers, losses, and scoring
+
+import copy
+
+import torch
+from torch.utils.checkpoint import checkpoint
+from torch_geometric.data import Batch
+from torch_geometric.utils import scatter, spmm, to_torch_csr_tensor
+
+from problem.bitpack import BitLayout
+
+class GraphOperator():
+    # memory_budget: if set, the bytes allowed for edge-level intermediates in losses and gradients
+    def __init__(self, batch, memory_budget=None):
+        edge_index = batch.edge_index
+        device = edge_index.device
+
+        self.num_nodes = batch.num_nodes
+        self.num_edges = edge_index.shape[1]
+        self.edge_index = edge_index
+        self.src = edge_index[0]
+        self.dst = edge_index[1]
+
+        # weight vectors, defaulting to all ones
+        edge_weight = getattr(batch, 'edge_weight', None)
+        if edge_weight is None:
+            edge_weight = torch.ones(self.num_edges, device=device)
+        self.edge_weight = edge_weight
+
+        # present when each undirected edge is stored once (see data/transforms.py::ToHalfEdges)
+        # it counts the directed edges each stored edge stands for
+        self.edge_multiplicity = getattr(batch, 'edge_multiplicity', None)
+        if self.edge_multiplicity is None:
+            self.num_directed_edges = self.num_edges
+        else:
+            self.num_directed_edges = int(self.edge_multiplicity.sum())
+
+        node_weight = getattr(batch, 'node_weight', None)
+        if node_weight is None:
+            node_weight = torch.ones(self.num_nodes, device=device)
+        self.node_weight = node_weight
+
+        # graph membership of each node, for per-graph reductions
+        node_graph = getattr(batch, 'batch', None)
+        if node_graph is None:
+            node_graph = torch.zeros(self.num_nodes, dtype=torch.long, device=device)
+        self.node_graph = node_graph
+        self.num_graphs = getattr(batch, 'num_graphs', 1)
+
+        self.memory_budget = memory_budget
+
+        # built on first use
+        self._adj = None
+        self._edge_graph = None
+        self._graph_num_directed_edges = None
+        self._bit_layout = None
+
+    # CSR form of A + A^T, so that bilinear forms sum_ij w_ij <x_i, x_j> have gradient adj @ X
+    @property
+    def adj(self):
+        if self._adj is None:
+            self._adj = self.symmetric_csr(self.edge_weight)
+        return self._adj
+
+    # CSR form of A + A^T where A holds the given per-edge values
+    # without_self_loops: drop edges (i, i), whose terms don't depend on the sign of x_i
+    def symmetric_csr(self, edge_values, without_self_loops=False):
+        edge_index = torch.cat((self.edge_index, self.edge_index.flip(0)), dim=1)
+        edge_values = edge_values.repeat(2)
+        if without_self_loops:
+            mask = edge_index[0] != edge_index[1]
+            edge_index = edge_index[:, mask]
+            edge_values = edge_values[mask]
+        return to_torch_csr_tensor(edge_index, edge_values, size=(self.num_nodes, self.num_nodes))
+
+    # graph membership of each edge
+    @property
+    def edge_graph(self):
+        if self._edge_graph is None:
+            self._edge_graph = self.node_graph[self.src]
+        return self._edge_graph
+
+    # number of directed edges in each graph
+    @property
+    def graph_num_directed_edges(self):
+        if self._graph_num_directed_edges is None:
+            counts = self.edge_multiplicity
+            if counts is None:
+                counts = torch.ones(self.num_edges, device=self.src.device)
+            self._graph_num_directed_edges = self.graph_sum(counts, self.edge_graph)
+        return self._graph_num_directed_edges
+
+    # word and bit positions of each node for bit-packed assignments (see problem/bitpack.py)
+    @property
+    def bit_layout(self):
+        if self._bit_layout is None:
+            self._bit_layout = BitLayout(self)
+        return self._bit_layout
+
+    # sum values (..., M) into their graphs (..., num_graphs) according to index (M,)
+    def graph_sum(self, values, index):
+        return scatter(values, index, dim=-1, dim_size=self.num_graphs, reduce='sum')
+
+    # (A + A^T) X
+    def matmul(self, X):
+        return spmm(self.adj, X, reduce='sum')
+
+    # how many terms of bytes_per_term each fit in the memory budget?
+    def chunk_size(self, length, bytes_per_term):
+        if self.memory_budget is None:
+            return length
+        return max(1, int(self.memory_budget // bytes_per_term))
+
+    # compute fn(0, length) as a sum of fn(start, end) over chunks that fit in the memory budget
+    # when differentiating, each chunk is checkpointed so its intermediates are recomputed
+    # during backward instead of being kept alive for the whole pass
+    def chunked_sum(self, fn, length, bytes_per_term, requires_grad=False):
+        chunk = self.chunk_size(length, bytes_per_term)
+        if chunk >= length:
+            return fn(0, length)
+
+        total = 0.
+        for start in range(0, length, chunk):
+            end = min(start + chunk, length)
+            if requires_grad and torch.is_grad_enabled():
+                total = total + checkpoint(fn, start, end, use_reentrant=False)
+            else:
+                total = total + fn(start, end)
+        return total
+
+# fetch the operator attached to a batch, building and attaching one if it's missing
+def get_operator(batch):
+    op = getattr(batch, 'operator', None)
+    if op is None:
+        op = GraphOperator(batch)
+        batch.operator = op
+    return op
+
+# sub-batch of a featurized batch holding only the given graphs (sorted ascending), in the same node order
+# the sub-batch gets the same penalty and a fresh operator with the same memory budget
+def select_graphs(batch, graphs):
+    operator = getattr(batch, 'operator', None)
+    penalty = getattr(batch, 'penalty', None)
+
+    # the operator and penalty aren't collated attributes, so strip them before separating
+    batch = copy.copy(batch)
+    for key in ('operator', 'penalty'):
+        if key in batch:
+            del batch[key]
+
+    sub_batch = Batch.from_data_list(batch.index_select(graphs))
+    sub_batch.penalty = penalty
+    memory_budget = operator.memory_budget if operator is not None else None
+    sub_batch.operator = GraphOperator(sub_batch, memory_budget=memory_budget)
+    return sub_batch
@@ -1,9 +1,15 @@
-from problem.losses import max_cut_obj, vertex_cover_obj, vertex_cover_constraint
+from problem.losses import max_cut_obj, max_cut_grad, vertex_cover_obj, vertex_cover_constraint
+from problem.losses import vertex_cover_obj_grad, vertex_cover_constraint_grad
 from problem.losses import max_cut_score, vertex_cover_score, max_clique_score
+from problem.losses import max_cut_graph_obj, vertex_cover_graph_obj, vertex_cover_graph_constraint
+from problem.losses import max_cut_graph_score, vertex_cover_graph_score, max_cut_bulk_score
+from problem.losses import max_cut_packed_score, vertex_cover_packed_score
+from problem.operators import get_operator
 from networkx.algorithms.approximation import one_exchange, min_weighted_vertex_cover
 from problem.baselines import max_cut_sdp, vertex_cover_sdp
 from problem.baselines import max_cut_gurobi, vertex_cover_gurobi
-from data.sat import sdp_objective, sdp_constraint
+from data.sat import sdp_objective, sdp_constraint, sdp_objective_grad, sdp_constraint_grad
+from data.sat import sdp_graph_objective, sdp_graph_constraint, sat_clause_counts, sat_packed_clause_counts
 import torch
 import numpy as np
 
@@ -19,6 +25,30 @@ def get_problem(args):
     else:
         raise ValueError(f"get_problem got invalid problem_type {args.problem_type}")
 
+# does this problem supply a closed-form gradient of its loss?
+def has_grad(problem):
+    return problem.grad is not OptProblem.grad
+
+# X as a float tensor of shape (..., N, r)
+def as_columns(X):
+    if isinstance(X, np.ndarray):
+        X = torch.FloatTensor(X)
+    if len(X.shape) == 1:
+        X = X[:, None]
+    return X
+
+# a copy of the SAT assignments X (..., N, r) with each pair variable recomputed from its singles,
+# leaving the caller's X unmodified
+def recompute_pairs(X, batch):
+    pair_index = batch.pair_index
+    X = X.clone()
+    X[..., pair_index[0], :] = X[..., pair_index[1], :] * X[..., pair_index[2], :]
+    return X
+
+# can this problem score bit-packed assignments directly?
+def has_packed_score(problem):
+    return problem.packed_score is not OptProblem.packed_score
+
 # Bundle losses, constraints, and utilities for a constrained optimization problem
 class OptProblem():
     @staticmethod
@@ -37,10 +67,40 @@ class OptProblem():
     def loss(X, batch):
         raise NotImplementedError()
 
+    # gradient of loss w.r.t. X; problems without one fall back to autograd
+    @staticmethod
+    def grad(X, batch):
+        raise NotImplementedError()
+
     @staticmethod
     def score(args, X, example):
         raise NotImplementedError()
 
+    # per-graph versions of objective, constraint, and score
+    # X is (..., N, r), possibly with leading candidate dimensions; results are (..., num_graphs)
+    @staticmethod
+    def batch_objective(X, batch):
+        raise NotImplementedError()
+
+    @staticmethod
+    def batch_constraint(X, batch):
+        raise NotImplementedError()
+
+    @staticmethod
+    def batch_score(args, X, batch):
+        raise NotImplementedError()
+
+    # batch_score on bit-packed assignments (..., num_words), see problem/bitpack.py
+    @staticmethod
+    def packed_score(args, words, batch, chunk_size=None):
+        raise NotImplementedError()
+
+    # per-graph (score, objective, constraint), each (..., num_graphs), from a single pass over X
+    # equal to (batch_score, batch_objective, batch_constraint), without recomputing shared terms
+    @staticmethod
+    def evaluate(args, X, batch):
+        raise NotImplementedError()
+
     @staticmethod
     def greedy(G):
         raise NotImplementedError()
@@ -66,10 +126,41 @@ class MaxCutProblem(OptProblem):
     def loss(X, batch):
         return max_cut_obj(X, batch)
 
+    @staticmethod
+    def grad(X, batch):
+        return max_cut_grad(X, batch)
+
     @staticmethod
     def score(args, X, example):
         return max_cut_score(args, X, example)
 
+    @staticmethod
+    def batch_objective(X, batch):
+        return max_cut_graph_obj(X, batch)
+
+    @staticmethod
+    def batch_constraint(X, batch):
+        return torch.zeros(X.shape[:-2] + (get_operator(batch).num_graphs,), device=X.device)
+
+    # rounded assignments, with a single column, are scored in bulk with one sparse matmul
+    @staticmethod
+    def batch_score(args, X, batch):
+        if X.shape[-1] == 1 and not X.requires_grad:
+            return max_cut_bulk_score(args, X, batch)
+        return max_cut_graph_score(args, X, batch)
+
+    @staticmethod
+    def packed_score(args, words, batch, chunk_size=None):
+        return max_cut_packed_score(args, words, batch, chunk_size=chunk_size)
+
+    # the objective is recovered from the score, as score = (E - objective) / 2
+    @staticmethod
+    def evaluate(args, X, batch):
+        X = as_columns(X)
+        score = MaxCutProblem.batch_score(args, X, batch)
+        objective = get_operator(batch).graph_num_directed_edges - 2. * score
+        return score, objective, MaxCutProblem.batch_constraint(X, batch)
+
     @staticmethod
     def greedy(G):
         greedy_score, _ = one_exchange(G)
@@ -102,10 +193,39 @@ class VertexCoverProblem(OptProblem):
         return vertex_cover_obj(X, batch) + \
             batch.penalty * vertex_cover_constraint(X, batch)
 
+    @staticmethod
+    def grad(X, batch):
+        return vertex_cover_obj_grad(X, batch) + \
+            batch.penalty * vertex_cover_constraint_grad(X, batch)
+
     @staticmethod
     def score(args, X, example):
         return vertex_cover_score(args, X, example)
 
+    @staticmethod
+    def batch_objective(X, batch):
+        return vertex_cover_graph_obj(X, batch)
+
+    @staticmethod
+    def batch_constraint(X, batch):
+        return vertex_cover_graph_constraint(as_columns(X), batch)
+
+    @staticmethod
+    def batch_score(args, X, batch):
+        return vertex_cover_graph_score(args, as_columns(X), batch)
+
+    @staticmethod
+    def packed_score(args, words, batch, chunk_size=None):
+        return vertex_cover_packed_score(args, words, batch, chunk_size=chunk_size)
+
+    # the constraint's edge pass is shared with the score
+    @staticmethod
+    def evaluate(args, X, batch):
+        X = as_columns(X)
+        objective = vertex_cover_graph_obj(X, batch)
+        constraint = vertex_cover_graph_constraint(X, batch)
+        return -(objective + constraint), objective, constraint
+
     @staticmethod
     def greedy(G):
         cover = min_weighted_vertex_cover(G)
@@ -144,6 +264,13 @@ class SATProblem(OptProblem):
 
         return -objective + batch.penalty * constraint
 
+    @staticmethod
+    def grad(X, batch):
+        objective_grad = sdp_objective_grad(X, batch)
+        constraint_grad = sdp_constraint_grad(X, batch)
+
+        return -objective_grad + batch.penalty * constraint_grad
+
     @staticmethod
     def score(args, X, example):
         if isinstance(X, np.ndarray):
@@ -163,6 +290,62 @@ class SATProblem(OptProblem):
 
         return objective - example.penalty * constraint
 
+    @staticmethod
+    def batch_objective(X, batch):
+        X = as_columns(X)
+
+        # rounded assignments count satisfied clauses directly, as in batch_score
+        if X.shape[-1] == 1 and not X.requires_grad:
+            return -sat_clause_counts(X, batch)
+
+        X = recompute_pairs(X, batch)
+
+        return -sdp_graph_objective(X, batch)
+
+    @staticmethod
+    def batch_constraint(X, batch):
+        X = as_columns(X)
+        X = recompute_pairs(X, batch)
+
+        return sdp_graph_constraint(X, batch)
+
+    @staticmethod
+    def batch_score(args, X, batch):
+        X = as_columns(X)
+
+        # rounded assignments, with a single column, are scored by counting satisfied clauses directly:
+        # with consistent pair variables, the objective is the satisfied count and the constraint is 0
+        if X.shape[-1] == 1 and not X.requires_grad:
+            return sat_clause_counts(X, batch)
+
+        X = recompute_pairs(X, batch)
+
+        objective = sdp_graph_objective(X, batch)
+        constraint = sdp_graph_constraint(X, batch)
+
+        return objective - batch.penalty * constraint
+
+    # satisfied clause counts, as batch_score gives for rounded assignments; pair variables are never read
+    @staticmethod
+    def packed_score(args, words, batch, chunk_size=None):
+        return sat_packed_clause_counts(words, batch, chunk_size=chunk_size)
+
+    # rounded assignments, with a single column, need only the satisfied clause counts: with pair variables
+    # recomputed from singles, the objective is minus the count and the constraint is 0
+    # otherwise, X is cloned once and shared by the objective and constraint
+    @staticmethod
+    def evaluate(args, X, batch):
+        X = as_columns(X)
+        if X.shape[-1] == 1 and not X.requires_grad:
+            satisfied = sat_clause_counts(X, batch)
+            return satisfied, -satisfied, torch.zeros_like(satisfied)
+
+        X = recompute_pairs(X, batch)
+
+        objective = sdp_graph_objective(X, batch)
+        constraint = sdp_graph_constraint(X, batch)
+        return objective - batch.penalty * constraint, -objective, constraint
+
     @staticmethod
     def greedy(G):
         pass
@@ -0,0 +1,77 @@
+# Batched WalkSAT / ProbSAT over the clauses of compile_sat (see data/sat.py)
+# many restarts run as rows of one (R, N) tensor of +/- 1 assignments, each row covering every formula
+# of the batch. each step, every (restart, formula) with an unsatisfied clause picks one at random and flips
+# one of its variables; formulas use disjoint variables, so the flips of a step never interact
+# only the single variables appearing in clauses are flipped; pair variables are left to the scorer
+
+import torch
+from torch_geometric.utils import scatter
+
+from data.sat import sat_clauses
+from problem.local_search import segment_argmax
+from problem.operators import get_operator
+
+# run WalkSAT (method='walksat') or ProbSAT (method='probsat') from the starting assignments X (R, N)
+#   walksat: flip a variable of the clause that breaks no satisfied clause if there is one; otherwise,
+#     with probability noise a random variable of the clause, else the one breaking the fewest clauses
+#   probsat: flip a variable of the clause with probability proportional to (eps + breaks)^-cb
+# returns the best assignments (R, N) of each restart, and their (R, num_graphs) satisfied clause counts
+def walksat(args, X, batch, steps=1000, method='walksat', noise=0.5, eps=0.9, cb=2.06):
+    op = get_operator(batch)
+    clauses, signs, clause_graph = sat_clauses(batch)
+    R = X.shape[0]
+    G = op.num_graphs
+    device = X.device
+
+    X = torch.where(X == 0, 1., X.float())
+    num_clauses = scatter(torch.ones_like(clause_graph), clause_graph, dim=0, dim_size=G, reduce='sum')
+    flat_clauses = clauses.reshape(-1).expand(R, -1)
+    rows = torch.arange(R, device=device)[:, None]
+
+    best_X = X
+    best_unsat = None
+    for step in range(steps + 1):
+        # (R, K, 3) truth of each literal, and the unsatisfied clauses of each formula
+        literals = signs * X[:, clauses] > 0
+        true_count = literals.sum(dim=-1)
+        unsat = true_count == 0
+        num_unsat = scatter(unsat.long(), clause_graph, dim=-1, dim_size=G, reduce='sum')
+
+        if best_unsat is None:
+            best_unsat = num_unsat
+        improved = num_unsat < best_unsat
+        best_unsat = torch.where(improved, num_unsat, best_unsat)
+        best_X = torch.where(improved[:, op.node_graph], X, best_X)
+
+        if step == steps or not (best_unsat > 0).any():
+            break
+
+        # a uniformly random unsatisfied clause of each (restart, formula)
+        key = torch.where(unsat, torch.rand(unsat.shape, device=device), -1.)
+        key_max, clause = segment_argmax(key, clause_graph, G)
+        active = key_max >= 0
+        clause = clause.clamp(max=len(clauses) - 1)
+        variables = clauses[clause] # (R, G, 3)
+
+        # breaks: satisfied clauses whose only true literal is this variable
+        critical = (literals & (true_count == 1)[:, :, None]).reshape(R, -1).float()
+        breaks = torch.zeros_like(X).scatter_add_(1, flat_clauses, critical)
+        breaks = breaks.gather(1, variables.reshape(R, -1)).reshape(R, G, 3)
+
+        if method == 'walksat':
+            least = breaks.argmin(dim=-1)
+            random_choice = torch.randint(0, 3, least.shape, device=device)
+            walk = (torch.rand(least.shape, device=device) < noise) & (breaks.min(dim=-1).values > 0)
+            choice = torch.where(walk, random_choice, least)
+        elif method == 'probsat':
+            weights = (eps + breaks) ** -cb
+            choice = torch.multinomial(weights.reshape(-1, 3), 1).reshape(R, G)
+        else:
+            raise ValueError(f"Invalid walksat method: {method}")
+
+        u = variables.gather(-1, choice[:, :, None])[:, :, 0]
+        flip = torch.zeros_like(X)
+        flip[rows.expand_as(u)[active], u[active]] = 1.
+        X = torch.where(flip > 0, -X, X)
+
+    return best_X, num_clauses - best_unsat
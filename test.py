@@ -12,8 +12,7 @@ from model.saving import load_model
 import pickle
 from datetime import datetime
 import numpy as np
-from problem.baselines import random_hyperplane_projector
-from model.training import featurize_batch
+from model.training import multi_restart
 import time
 from problem.problems import get_problem
 
@@ -32,50 +31,48 @@ def time_and_scores(args, model, test_loader, problem, stop_early=False):
     total_count = 0    
     times = []
     scores = []
+    layers_used = []
+    hyperplanes_used = []
+    constraints = []
     with torch.no_grad():
         for batch in test_loader:
             start_time = time.time()
 
-            x_projs = []
-            for attempt in range(10):
-                x_in, batch = featurize_batch(args, batch)
+            # all attempts run as one replicated batch
+            stats = {}
+            x_proj, batch_scores, loss = multi_restart(args, model, batch, problem, restarts=args.restarts, stats=stats)
+            total_loss += float(loss)
 
-                x_out = model(x_in, batch)
-                loss = problem.loss(x_out, batch)
-
-                total_loss += float(loss)
-
-                x_proj = random_hyperplane_projector(args, x_out, batch, problem.score)
-
-                # ENSURE we are getting a +/- 1 vector out by replacing 0 with 1
-                x_proj = torch.where(x_proj == 0, 1, x_proj)
-                num_zeros = (x_proj == 0).count_nonzero()
-                assert num_zeros == 0
+            end_time = time.time()
 
-                x_projs.append(x_proj)
+            # lift layers each graph ran before exiting, when exiting early
+            if getattr(model, 'layers_used', None) is not None:
+                layers_used += model.layers_used.tolist()
 
-            end_time = time.time()
+            # hyperplanes each graph was rounded with, summed over its restarts
+            hyperplanes_used += stats['hyperplanes_used'].sum(dim=0).tolist()
+            constraints += stats['constraints'].tolist()
 
             # append times
             times.append(end_time - start_time)
 
-            # count the score
-            for i in range(len(batch)):
-                attempt_scores = []
-                for attempt in range(10):
-                    example_x_proj = x_projs[attempt][batch.ptr[i]:batch.ptr[i + 1]]
-                    example = batch.get_example(i)
-                    example.penalty = args.penalty
-                    score = problem.score(args, example_x_proj, example)
-                    attempt_scores.append(float(score))
-                print(max(attempt_scores))
-                scores.append(max(attempt_scores))
+            # count the best score for each graph
+            for score in batch_scores.tolist():
+                print(score)
+                scores.append(score)
 
             total_count += len(batch)
 
             if stop_early:
                 return scores, times
 
+    if len(layers_used) > 0:
+        print(f'average lift layers used: {sum(layers_used) / len(layers_used)}')
+    if len(hyperplanes_used) > 0:
+        print(f'average hyperplanes used per graph: {sum(hyperplanes_used) / len(hyperplanes_used)}')
+    if len(constraints) > 0:
+        print(f'average constraint violation: {sum(constraints) / len(constraints)}')
+
     return scores, times
 
 if __name__ == '__main__':
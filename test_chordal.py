@@ -1,6 +1,7 @@
 
 # loads model and runs it on data. 
 
+import copy
 import torch
 from utils.parsing import parse_test_args
 import json
@@ -12,11 +13,9 @@ from model.saving import load_model
 import pickle
 from datetime import datetime
 import numpy as np
-from problem.baselines import random_hyperplane_projector
-from model.training import featurize_batch
+from model.training import multi_restart
 import time
 from problem.problems import get_problem
-import math
 
 from torch_geometric.utils.convert import from_networkx
 
@@ -36,36 +35,24 @@ def time_and_scores(args, model, test_loader, problem, stop_early=False):
 
     results = {}
 
+    # chordal examples are scored with penalty 1, without changing the caller's args
+    chordal_args = copy.copy(args)
+    chordal_args.penalty = 1.
+
     with torch.no_grad():
         for example in test_loader:
             start_time = time.time()
 
             example = from_networkx(example)
 
-            score = -math.inf
-            for attempt in range(100):
-                x_in, example = featurize_batch(args, example)
-                example.penalty = 1.
-
-                x_out = model(x_in, example)
-                loss = problem.loss(x_out, example)
-
-                total_loss += float(loss)
-
-                x_proj = random_hyperplane_projector(args, x_out, example, problem.score)
-                end_time = time.time()
-
-                # append times
-                times.append(end_time - start_time)
-
-                # ENSURE we are getting a +/- 1 vector out by replacing 0 with 1
-                x_proj = torch.where(x_proj == 0, 1, x_proj)
-
-                num_zeros = (x_proj == 0).count_nonzero()
-                assert num_zeros == 0
+            # all --restarts attempts run as one replicated batch
+            x_proj, example_scores, loss = multi_restart(chordal_args, model, example, problem, restarts=args.restarts)
+            total_loss += float(loss)
+            score = float(example_scores[0])
+            end_time = time.time()
 
-                # count the score
-                score = max(problem.score(args, x_proj, example), score)
+            # append times
+            times.append(end_time - start_time)
 
             if stop_early:
                 return scores, times
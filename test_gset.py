@@ -12,11 +12,9 @@ from model.saving import load_model
 import pickle
 from datetime import datetime
 import numpy as np
-from problem.baselines import random_hyperplane_projector
-from model.training import featurize_batch
+from model.training import multi_restart
 import time
 from problem.problems import get_problem
-import math
 
 from data.gset import load_gset
 
@@ -45,25 +43,10 @@ def time_and_scores(args, model, test_loader, problem, stop_early=False):
             for example in batch.to_data_list():
                 start_time = time.time()
 
-                score = -math.inf
-                for attempt in range(100):
-                    x_in, example = featurize_batch(args, example)
-
-                    x_out = model(x_in, example)
-                    loss = problem.loss(x_out, example)
-
-                    total_loss += float(loss)
-
-                    x_proj = random_hyperplane_projector(args, x_out, example, problem.score)
-
-                    # ENSURE we are getting a +/- 1 vector out by replacing 0 with 1
-                    x_proj = torch.where(x_proj == 0, 1, x_proj)
-
-                    num_zeros = (x_proj == 0).count_nonzero()
-                    assert num_zeros == 0
-
-                    # count the score
-                    score = max(problem.score(args, x_proj, example), score)
+                # all --restarts attempts run as one replicated batch
+                x_proj, example_scores, loss = multi_restart(args, model, example, problem, restarts=args.restarts)
+                total_loss += float(loss)
+                score = float(example_scores[0])
 
                 end_time = time.time()
 
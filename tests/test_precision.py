@@ -0,0 +1,57 @@
+# bf16 forward passes for each problem type
+# run from the repository root: python -m pytest tests
+
+from argparse import Namespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torch_geometric')
+
+from torch_geometric.data import Batch, Data
+from torch_geometric.utils import erdos_renyi_graph
+
+from data.sat import random_3sat_generator
+from model.models import construct_model
+from model.training import featurize_batch, precision_context, run_inference
+from problem.problems import get_problem
+
+def make_args(problem_type):
+    return Namespace(problem_type=problem_type, model_type='LiftMP', rank=8, num_layers=2,
+                     repeat_lift_layers=None, checkpoint_layers=0, lr=0.001, finetune_from=None,
+                     device='cpu', positional_encoding=None, pe_dimension=0, penalty=1.,
+                     precision='bf16')
+
+def make_batch(problem_type):
+    torch.manual_seed(0)
+    if problem_type == 'sat':
+        formulas = random_3sat_generator(0, n_min=10, n_max=10, k_min=20, k_max=20)
+        return Batch.from_data_list([next(formulas) for _ in range(2)])
+    graphs = [Data(edge_index=erdos_renyi_graph(12, 0.3), num_nodes=12) for _ in range(2)]
+    return Batch.from_data_list(graphs)
+
+@pytest.mark.parametrize('problem_type', ['max_cut', 'vertex_cover', 'sat'])
+def test_bf16_training_step(problem_type):
+    args = make_args(problem_type)
+    model, _ = construct_model(args)
+    problem = get_problem(args)
+    x_in, batch = featurize_batch(args, make_batch(problem_type))
+
+    with precision_context(args):
+        x_out = model(x_in, batch)
+    loss = problem.loss(x_out.float(), batch)
+    loss.backward()
+
+    assert torch.isfinite(loss)
+
+@pytest.mark.parametrize('problem_type', ['max_cut', 'vertex_cover', 'sat'])
+def test_bf16_inference(problem_type):
+    args = make_args(problem_type)
+    model, _ = construct_model(args)
+    x_in, batch = featurize_batch(args, make_batch(problem_type))
+
+    x_out = run_inference(args, model, x_in, batch)
+
+    assert x_out.dtype == torch.float
+    assert x_out.shape == x_in.shape
+    assert torch.isfinite(x_out).all()
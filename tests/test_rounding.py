@@ -0,0 +1,41 @@
+# early stopping of hyperplane rounding under the default rounding memory budget
+# run from the repository root: python -m pytest tests
+
+from argparse import Namespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torch_geometric')
+pytest.importorskip('gurobipy')
+pytest.importorskip('mosek')
+
+from torch_geometric.data import Batch, Data
+from torch_geometric.utils import erdos_renyi_graph
+
+from problem.baselines import random_hyperplane_projector
+from problem.problems import MaxCutProblem
+
+# the README's ErdosRenyi configuration: n=100, p=0.15, rank 16
+def make_inputs(num_graphs=4):
+    torch.manual_seed(0)
+    graphs = [Data(edge_index=erdos_renyi_graph(100, 0.15), num_nodes=100) for _ in range(num_graphs)]
+    batch = Batch.from_data_list(graphs)
+    x_lift = torch.nn.functional.normalize(torch.randn((batch.num_nodes, 16)), dim=1)
+    return Namespace(problem_type='max_cut'), x_lift, batch
+
+def test_patience_stops_with_default_budget():
+    args, x_lift, batch = make_inputs()
+    x_proj, used = random_hyperplane_projector(args, x_lift, batch, MaxCutProblem.batch_score,
+                                               n_hyperplanes=1000, patience=10, return_used=True)
+
+    assert x_proj.shape == (batch.num_nodes,)
+    assert (used < 1000).all()
+
+def test_time_budget_stops_with_default_budget():
+    args, x_lift, batch = make_inputs()
+    x_proj, used = random_hyperplane_projector(args, x_lift, batch, MaxCutProblem.batch_score,
+                                               n_hyperplanes=1000, time_budget=0., return_used=True)
+
+    assert x_proj.shape == (batch.num_nodes,)
+    assert (used < 1000).all()
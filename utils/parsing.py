@@ -90,6 +90,43 @@ def add_dataset_args(parser: ArgumentParser):
     parser.add_argument('--split_seed', type=int, default=0,
                         help='Seed to use for train/val/test split')
 
+def add_runtime_args(parser: ArgumentParser):
+    """
+    Adds arguments controlling how the model is executed to an ArgumentParser.
+
+    :param parser: An ArgumentParser.
+    """
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='Precision for the model forward pass; bf16 uses autocast, with losses and scores kept in fp32')
+    parser.add_argument('--compile', type=bool, default=False,
+                        help='Run LiftMP/FullMP layers, gradients, and loss through torch.compile (falls back to eager if a forward call fails to compile; backward failures still raise)')
+
+def add_rounding_args(parser: ArgumentParser):
+    """
+    Adds hyperplane rounding and local search refinement arguments to an ArgumentParser.
+
+    :param parser: An ArgumentParser.
+    """
+    parser.add_argument('--rounding_memory_budget', type=float, default=1024,
+                        help='Memory budget in MB for hyperplane rounding; hyperplanes are rounded and scored in groups that fit')
+    parser.add_argument('--hyperplane_sampler', type=str, default='gaussian',
+                        choices=['gaussian', 'orthogonal', 'sobol', 'antithetic'],
+                        help='How to draw the hyperplanes for rounding (see problem/baselines.py::hyperplane_sampler)')
+    parser.add_argument('--local_search', type=bool, default=False,
+                        help='Refine rounded assignments with local search (max_cut and vertex_cover; sat with --refinement=walksat)')
+    parser.add_argument('--local_search_candidates', type=int, default=1,
+                        help='With --local_search, refine this many of the best rounded assignments of each graph and keep the best')
+    parser.add_argument('--refinement', type=str, default='greedy', choices=['greedy', 'tabu', 'annealing', 'walksat'],
+                        help='With --local_search: greedy flips to a local optimum, tabu search (one chain per candidate), or parallel-tempering annealing (each candidate replicated across --temperatures); walksat for sat')
+    parser.add_argument('--walksat_method', type=str, default='walksat', choices=['walksat', 'probsat'],
+                        help='Variable selection for --refinement=walksat')
+    parser.add_argument('--refine_steps', type=int, default=1000,
+                        help='Number of steps for tabu and annealing refinement')
+    parser.add_argument('--tabu_tenure', type=int, default=10,
+                        help='Number of steps a flipped variable stays tabu')
+    parser.add_argument('--temperatures', type=int, default=8,
+                        help='Number of temperature levels for parallel-tempering annealing; each candidate runs one chain per level')
+
 def add_train_args(parser: ArgumentParser):
     """
     Adds training arguments to an ArgumentParser.
@@ -119,6 +156,12 @@ def add_train_args(parser: ArgumentParser):
                         help="model file to load weights from for finetuning")
     parser.add_argument('--lift_file', type=str, default=None, 
                         help="model file from which to load lift network")
+    parser.add_argument('--checkpoint_layers', type=int, default=0,
+                        help='Checkpoint every k LiftMP/FullMP layers, recomputing their activations during backward to save memory (0 to disable)')
+    parser.add_argument('--loss_memory_budget', type=float, default=None,
+                        help='Memory budget in MB for edge-level intermediates in losses and gradients; edges are processed in chunks to fit (default: no chunking)')
+    add_runtime_args(parser)
+    add_rounding_args(parser)
 
     # Training parameters
     parser.add_argument('--lr', type=float, default=0.001,
@@ -142,6 +185,9 @@ def add_train_args(parser: ArgumentParser):
     parser.add_argument('--train_fraction', type=float, default=0.8,
                         help='Fraction of data to retain for training. Remainder goes to validation/testing.')
 
+    parser.add_argument('--half_edges', type=bool, default=False,
+                        help='Store each undirected edge once instead of in both directions (LiftMP/FullMP/ProjectMP only)')
+
 def hash_dict(d):
     # Convert the dictionary to a sorted tuple of key-value pairs
     sorted_items = str(tuple(sorted(d.items())))
@@ -157,6 +203,19 @@ def check_args(args: Namespace):
             raise ValueError(f'dataset = {args.dataset} not valid for problem_type = {args.problem_type}')
         #if args.batch_size != 1:
         #    raise ValueError(f'batch_size != 1 not valid for problem_type = {args.problem_type}')
+    if getattr(args, 'half_edges', False):
+        # message passing GNNs and on-the-fly random walk PEs need both edge directions
+        if args.model_type not in ['LiftMP', 'FullMP', 'ProjectMP']:
+            raise ValueError(f'half_edges not valid for model_type = {args.model_type}')
+        if args.infinite and args.positional_encoding == 'random_walk':
+            raise ValueError('half_edges not valid with infinite data and random_walk positional encoding')
+    if getattr(args, 'local_search', False):
+        # walksat refines sat clauses; the flip refinements need the max_cut or vertex_cover flip gains
+        refinement = getattr(args, 'refinement', 'greedy')
+        if refinement == 'walksat' and args.problem_type != 'sat':
+            raise ValueError(f'refinement = walksat not valid for problem_type = {args.problem_type}')
+        if refinement != 'walksat' and args.problem_type not in ['max_cut', 'vertex_cover']:
+            raise ValueError(f'refinement = {refinement} not valid for problem_type = {args.problem_type}')
     return
 
 def modify_train_args(args: Namespace):
@@ -234,6 +293,20 @@ def parse_test_args() -> Namespace:
                         help='test_problem_type')
     parser.add_argument('--seed', type=str, default=0,
                         help='Torch random seed to use to initialize networks')
+    parser.add_argument('--restarts', type=int, default=10,
+                        help='Number of random restarts per graph, run together as one replicated batch')
+    parser.add_argument('--hyperplanes', type=int, default=1000,
+                        help='Number of random hyperplanes to round each graph with')
+    parser.add_argument('--packed_rounding', type=bool, default=False,
+                        help='Hold rounded candidates as bit-packed sign vectors while scoring them (max_cut, vertex_cover and sat)')
+    parser.add_argument('--rounding_patience', type=int, default=None,
+                        help='If set, stop rounding a graph once this many hyperplanes in a row have not improved its best score')
+    parser.add_argument('--rounding_time_budget', type=float, default=None,
+                        help='If set, stop rounding a batch after this many seconds')
+    parser.add_argument('--exit_tol', type=float, default=None,
+                        help='If set, stop running lift layers on a graph once no node embedding changes by more than this in one layer')
+    add_runtime_args(parser)
+    add_rounding_args(parser)
     add_dataset_args(parser)
     args = parser.parse_args()
 
@@ -280,6 +353,10 @@ def modify_baseline_args(args: Namespace):
         args.log_dir = "baseline_runs/" + args.prefix + f"_paramhash:{hashed_params}"
     args.batch_size = 1
 
+    # walksat runs on sat clauses
+    if args.walksat and args.problem_type != 'sat':
+        raise ValueError(f'walksat not valid for problem_type = {args.problem_type}')
+
 def parse_baseline_args() -> Namespace:
     parser = ArgumentParser()
     add_general_args(parser)
@@ -292,6 +369,14 @@ def parse_baseline_args() -> Namespace:
                         help='Timeout for Gurobi if desired')
     parser.add_argument('--greedy', type=bool, default=False,
                         help='Run greedy')
+    parser.add_argument('--walksat', type=bool, default=False,
+                        help='Run batched WalkSAT from random assignments (sat only)')
+    parser.add_argument('--walksat_restarts', type=int, default=32,
+                        help='Number of WalkSAT restarts, run in parallel')
+    parser.add_argument('--walksat_steps', type=int, default=10000,
+                        help='Number of WalkSAT steps per restart')
+    parser.add_argument('--walksat_method', type=str, default='walksat', choices=['walksat', 'probsat'],
+                        help='WalkSAT or ProbSAT variable selection')
 
     parser.add_argument('--start_index', type=int, default=None,
                         help='Start index in dataset, for partial runs (only run i >= start_index)')
@@ -306,3 +391,28 @@ def parse_baseline_args() -> Namespace:
     args = parser.parse_args()
     modify_baseline_args(args)
     return args
+
+def parse_benchmark_args() -> Namespace:
+    """
+    Parses arguments for benchmark.py: the training arguments, plus benchmark settings.
+
+    :return: A Namespace containing the parsed, modified, and validated args.
+    """
+    parser = ArgumentParser()
+    add_general_args(parser)
+    add_train_args(parser)
+    add_dataset_args(parser)
+    parser.add_argument('--benchmark', type=str, default='compile',
+                        choices=['compile', 'bf16', 'hyperplanes'],
+                        help='Which benchmark to run')
+    parser.add_argument('--benchmark_steps', type=int, default=50,
+                        help='Number of timed steps per configuration')
+    parser.add_argument('--warmup_steps', type=int, default=5,
+                        help='Number of untimed steps before timing (includes compilation)')
+    parser.add_argument('--hyperplane_counts', type=int, nargs='+', default=[10, 30, 100, 300, 1000],
+                        help='Numbers of hyperplanes to compare samplers at, for --benchmark=hyperplanes')
+    args = parser.parse_args()
+    modify_train_args(args)
+    check_args(args)
+
+    return args